@@ -32,6 +32,7 @@ __version__ = '0.0.7'
 __docformat__ = 'restructuredtext'
 
 
+import atexit
 import errno
 import grp
 import os
@@ -39,10 +40,16 @@ import pwd
 import resource
 import signal
 import sys
+import time
 
 
 UMASK = 0        # Default file mode creation mask of the daemon.
 MAXFD = 2048     # Default maximum for the number of available file descriptors.
+LOG_INFO = 6     # syslog priority of output redirected from stdout.
+LOG_ERR = 3      # syslog priority of output redirected from stderr.
+
+# Maps the spawn argument of Daemon to multiprocessing start methods.
+SPAWN = {'fork': 'fork', 'forkserver': 'forkserver', 'exec': 'spawn'}
 
 
 class Daemon(object):
@@ -52,7 +59,12 @@ class Daemon(object):
     '''
     def __init__(self, pidfile, workdir='/', sigmap=None,
                  user=None, group=None,
-                 stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
+                 stdin='/dev/null', stdout='/dev/null', stderr='/dev/null',
+                 profilesignal=None, profileseconds=30, stacksignal=None,
+                 memorysignal=None, memoryframes=25, flightrecorder=None,
+                 spawn='fork', preload=None, tuning=None, loadconfig=None,
+                 statefile=None, stateversion=0, idletimeout=None,
+                 reapchildren=False, standby=False):
         '''
         :param pidfile: must be the name of a file. The newly forked daemon
                         process will write it's pid to this file.
@@ -64,6 +76,11 @@ class Daemon(object):
         :param sigmap: dictionary mapping signals to callables. If `sigmap` is None
                        signal.SIGTERM is mapped to a default function that exits the
                        daemon process.
+                       The signals used by `profilesignal`, `stacksignal`,
+                       `memorysignal` and `reapchildren` must differ from
+                       each other and from those in `sigmap`, or ValueError
+                       is raised; so must `SIGHUP` when `loadconfig` is set
+                       and `sigmap` does not use it.
         :param user: can be the name or uid of a user. `Daemon.start` will switch
                      to this user to run the service. If `user` is None no user
                      switching will be done.
@@ -77,15 +94,133 @@ class Daemon(object):
                        standard sys.stdout file descriptor.
                        This argument is optional and defaults to `/dev/null`.
                        Note that stdout is opened unbuffered.
+                       `journald:[path]` or `syslog:[path]` send each line
+                       to the journald or syslog socket instead, with
+                       priority `LOG_INFO` (see `elib.daemon.logsink`).
         :param stderr: file name that will be opened and used to replace the
                        standard sys.stderr file descriptor.
                        This argument is optional and defaults to `/dev/null`.
                        Note that stderr is opened unbuffered.
+                       `journald:[path]` or `syslog:[path]` send each line
+                       to the journald or syslog socket instead, with
+                       priority `LOG_ERR`.
+        :param profilesignal: signal that starts sampling the stacks of all
+                              threads for `profileseconds` seconds. The
+                              collapsed stacks are written next to the stderr
+                              log, or to `workdir` when stderr is not a
+                              regular file. If `profilesignal` is None no
+                              profiling is available.
+        :param profileseconds: number of seconds a profiling run lasts.
+                               This argument is optional and defaults to 30.
+        :param stacksignal: signal that makes the daemon dump the stack of all
+                            threads to stderr. The dump is done by
+                            `faulthandler`, so it works even when the main
+                            thread is blocked. If `stacksignal` is None no
+                            stack dumps are available.
+        :param memorysignal: signal controlling memory diagnostics. The first
+                             time it is received `tracemalloc` is started.
+                             Every next time a report is written to `workdir`
+                             with the top allocation sites, the differences
+                             against the previous report, garbage collector
+                             counts and the object types using the most
+                             memory. If `memorysignal` is None no memory
+                             diagnostics are available.
+        :param memoryframes: number of frames `tracemalloc` stores per
+                             allocation.
+                             This argument is optional and defaults to 25.
+        :param flightrecorder: file name of a flight recorder (see
+                               `elib.daemon.flightrecorder`). When set,
+                               `Daemon.start` records daemon events and the
+                               `logging` records reaching the root logger
+                               into it and lets
+                               `faulthandler` write fatal errors to it. The
+                               recorder is available as `Daemon.recorder`.
+                               The file of the previous run is kept with a
+                               `.1` suffix. Forked workers do not record,
+                               their fatal errors go to stderr.
+                               A relative file name is relative to `workdir`.
+                               If `flightrecorder` is None no flight recorder
+                               is used.
+        :param spawn: how `Daemon.spawn` creates worker processes. `fork`
+                      forks the calling process, which gets slower as its
+                      resident memory grows. `forkserver` forks workers
+                      from a small server process started at the end of
+                      `Daemon.start`, before the application has grown.
+                      `exec` starts a fresh interpreter.
+                      This argument is optional and defaults to `fork`.
+        :param preload: list of module names the fork server imports before
+                        forking workers, so workers do not have to import
+                        them again. Only used when `spawn` is `forkserver`.
+                        Note that the main module is executed again in every
+                        worker started by `forkserver` or `exec`, keep its
+                        top level cheap or list its imports here.
+        :param tuning: dictionary of process tuning settings `Daemon.start`
+                       applies after switching user and group (see
+                       `elib.daemon.tuning` for the available settings).
+                       The settings are validated here. The outcome of each
+                       setting is written to stderr and stored in
+                       `Daemon.tuningreport`. If `tuning` is None no tuning
+                       is done.
+        :param loadconfig: callable without arguments that reads and
+                           validates the configuration of the service,
+                           raising an exception when it is invalid.
+                           `Daemon.start` loads the configuration and
+                           publishes it through `Daemon.config`, a
+                           `elib.daemon.config.ConfigChannel` workers use to
+                           pick up new versions, stored in a `.config.d`
+                           directory next to the pid file that belongs to
+                           `user` and `group`. `Daemon.reload` loads and
+                           publishes it again; `SIGHUP` is mapped to it
+                           unless `sigmap` already uses it. If `loadconfig`
+                           is None no configuration is managed.
+        :param statefile: file name of a state area handed from one
+                          generation of the daemon to the next (see
+                          `elib.daemon.state`). `Daemon.start` maps the state
+                          left by the previous generation, available as
+                          `Daemon.state.previous`. The application creates
+                          the next generation's state with
+                          `Daemon.state.create` and it is committed during
+                          `Daemon.shutdown`. A relative file name is
+                          relative to `workdir`. If `statefile` is None no
+                          state is handed over.
+        :param stateversion: version of the state layout. State written with
+                             another version is rejected.
+                             This argument is optional and defaults to 0.
+        :param idletimeout: number of seconds without activity after which
+                            the daemon shuts down gracefully, empties its
+                            pidfile and exits, so that socket activation or a
+                            launcher can start it again when needed. Activity
+                            is reported with `Daemon.touch`, and the daemon
+                            never counts as idle between `Daemon.acquire` and
+                            `Daemon.release`. Connections accepted for and
+                            requests handled by `Daemon.workers` pools count
+                            as activity too. If `idletimeout` is None the
+                            daemon never exits because it is idle.
+        :param reapchildren: when True, `Daemon.start` starts the daemon's
+                             `elib.daemon.children.Reaper` and maps `SIGCHLD`
+                             to waking it up. It only reaps children passed
+                             to `Reaper.watch` or started with
+                             `Reaper.spawn`, children the application waits
+                             for itself are left alone. The reaper is
+                             available as `Daemon.reaper`.
+                             This argument is optional and defaults to False.
+        :param standby: when True, another instance already running does not
+                        prevent `Daemon.start` from starting this one as a
+                        standby. The active instance holds a lock on the
+                        pidfile; a standby writes its pid to the pidfile
+                        with a `.standby` suffix and becomes active when it
+                        gets that lock in `Daemon.activate`, which happens
+                        as soon as the active instance dies. The pid file
+                        must not be removed while a standby waits.
+                        `Daemon.run` pre-warms resources and then waits to
+                        become active before running `main`.
+                        This argument is optional and defaults to False.
         '''
         if pidfile is None:
             sys.exit('Error: no pid file specified')
         else:
-            self.pidfile = pidfile
+            # Made absolute, the daemon changes to `workdir` after opening it.
+            self.pidfile = os.path.abspath(pidfile)
 
         if workdir is None or not os.path.isdir(workdir):
             sys.exit('Error: workdir \'%s\' does not exist' % workdir)
@@ -95,11 +230,99 @@ class Daemon(object):
         if sigmap is None:
             self.sigmap = {signal.SIGTERM: self._terminate}
         else:
-            self.sigmap = sigmap
+            self.sigmap = dict(sigmap)
+
+        self.profilesignal = profilesignal
+        self.profileseconds = profileseconds
+        self.stacksignal = stacksignal
+        self._sampler = None
+        self.memorysignal = memorysignal
+        self.memoryframes = memoryframes
+        self._tracer = None
+
+        if flightrecorder is None:
+            self.flightrecorder = None
+        else:
+            self.flightrecorder = os.path.join(self.workdir, flightrecorder)
+
+        self.recorder = None
+        self._recorderhandler = None
+        self._crashfile = None
+
+        if spawn not in SPAWN:
+            raise ValueError('spawn must be one of %s, but received \'%s\'' % (', '.join(sorted(SPAWN)), spawn))
+
+        self.spawnmethod = spawn
+        self.preload = list(preload or [])
+        self._mpcontext = None
+
+        if tuning is not None:
+            from elib.daemon import tuning as _tuning
+            _tuning.validate(tuning)
+
+        self.tuning = tuning
+        self.tuningreport = []
+
+        self.loadconfig = loadconfig
+        self.config = None
+
+        if statefile is None:
+            self.statefile = None
+        else:
+            self.statefile = os.path.join(self.workdir, statefile)
+
+        self.stateversion = stateversion
+        self.state = None
+
+        self._shutdownhooks = []
+        self._shutdown = False
+
+        self.scheduler = None
+
+        if idletimeout is not None and idletimeout <= 0:
+            raise ValueError('idletimeout must be positive, but received %s' % idletimeout)
+
+        self.idletimeout = idletimeout
+        # Created here so Daemon.acquire and Daemon.release work without an
+        # idle timeout and before Daemon.start, which moves them to shared
+        # memory.
+        import ctypes
+        import threading
+        self._lastactivity = ctypes.c_double(time.monotonic())
+        self._active = ctypes.c_longlong(0)
+        self._activelock = threading.Lock()
+        self._idleexit = False
+        self._pools = []
+
+        self.reapchildren = reapchildren
+        self.reaper = None
+
+        self.standby = standby
+        self.active = False
+        self._started = False
+        self._pidfd = None
+
+        # Map the signals used by the features enabled above. A signal can
+        # only have one use.
+        if loadconfig is not None and signal.SIGHUP not in self.sigmap:
+            self._mapsignal(signal.SIGHUP, self._reload)
+
+        if reapchildren:
+            self._mapsignal(signal.SIGCHLD, self._sigchld)
+
+        if profilesignal is not None:
+            self._mapsignal(profilesignal, self._profile)
+
+        if memorysignal is not None:
+            self._mapsignal(memorysignal, self._memory)
+
+        # stacksignal is handled by faulthandler, not through sigmap.
+        if stacksignal is not None and stacksignal in self.sigmap:
+            raise ValueError('signal %s is already in use' % stacksignal)
 
         if user is None:
             self.uid = None
-        elif isinstance(user, basestring):
+        elif isinstance(user, str):
             self.uid = pwd.getpwnam(user).pw_uid
         elif isinstance(user, int):
             self.uid = user
@@ -108,7 +331,7 @@ class Daemon(object):
 
         if group is None:
             self.gid = None
-        elif isinstance(group, basestring):
+        elif isinstance(group, str):
             self.gid = grp.getgrnam(group).gr_gid
         elif isinstance(group, int):
             self.gid = group
@@ -124,6 +347,10 @@ class Daemon(object):
         Daemonize the running script. When this method returns, the process is
         completely decoupled from the parent environment.
         '''
+        from elib.daemon import control
+        from elib.daemon import logsink
+        from elib.daemon import resources
+
         # Note: what's with sys.exit() and os._exit()?
         # os._exit is like sys.exit(), but it doesn't call any functions registered
         # with atexit (and on_exit) or any registered signal handlers.  It also
@@ -132,26 +359,25 @@ class Daemon(object):
         # removed.  It's therefore recommended that child branches of a fork()
         # and the parent branch of a daemon use os._exit().
 
-        # Prevent multiple instances. Note this is racy but good enough for now...
+        # Prevent multiple instances. Note this is racy, the pidfile lock
+        # taken after forking settles it.
         try:
             with open(self.pidfile, 'rb') as f:
                 pid = int(f.read().strip())
         except (IOError, ValueError):
             pass
         else:
-            try:
-                os.kill(pid, 0)
-            except OSError:
-                # good, pid is not running
-                pass
-            else:
-                # bail out, pid lives
+            # bail out if pid lives, unless we are a standby waiting for it
+            if control.alive(pid) and not self.standby:
                 sys.stderr.write('Already running as %s\n' % pid)
                 sys.stderr.flush()
                 os._exit(os.EX_OSERR)
 
         # Ensure directories for pidfile and self.std(in|out|err) exist
         for f in [self.pidfile, self.stdin, self.stdout, self.stderr]:
+            if logsink.parse(f) is not None:
+                continue
+
             if not os.path.isdir(os.path.abspath(os.path.dirname(f))):
                 os.makedirs(os.path.dirname(f), 0o755)
 
@@ -185,9 +411,17 @@ class Daemon(object):
             sys.stderr.flush()
             os._exit(os.EX_OSERR)
 
-        # Write pid file
-        with open(self.pidfile, 'wb') as f:
-            f.write(str(os.getpid()))
+        # Lock and write the pid file, or wait in standby.
+        self._pidfd = os.open(self.pidfile, os.O_RDWR | os.O_CREAT, 0o644)
+
+        if not self.activate(block=False):
+            if not self.standby:
+                sys.stderr.write('Already running, pid file %s is locked\n' % self.pidfile)
+                sys.stderr.flush()
+                os._exit(os.EX_OSERR)
+
+            with open(self.pidfile + '.standby', 'w') as f:
+                f.write(str(os.getpid()))
 
         # Reset the file mode creation mask.
         os.umask(UMASK)
@@ -198,6 +432,20 @@ class Daemon(object):
         # This is usually the root directory.
         os.chdir(self.workdir)
 
+        # The configuration is published in a directory next to the pid file,
+        # which is usually only writable before switching user.
+        if self.loadconfig is not None:
+            try:
+                if not os.path.isdir(self._configdir()):
+                    os.mkdir(self._configdir(), 0o700)
+
+                if self.uid is not None or self.gid is not None:
+                    os.chown(self._configdir(), -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+            except OSError as e:
+                sys.stderr.write('Failed to create configuration directory %s: %s\n' % (self._configdir(), e))
+                sys.stderr.flush()
+                os._exit(os.EX_OSERR)
+
         # Switch effective group
         if self.gid is not None:
             os.setegid(self.gid)
@@ -207,6 +455,11 @@ class Daemon(object):
             os.seteuid(self.uid)
             os.environ['HOME'] = pwd.getpwuid(self.uid).pw_dir
 
+        # Apply process tuning
+        if self.tuning is not None:
+            from elib.daemon import tuning
+            self.tuningreport = tuning.apply(self.tuning)
+
         # Attach signal handles
         for signum, callback in self.sigmap.items():
             signal.signal(signum, callback)
@@ -220,6 +473,7 @@ class Daemon(object):
 
         # Close all file descriptors except std(in|out|err).
         exclude = [x.fileno() for x in [self.stdin, self.stdout, self.stderr, sys.stdin, sys.stdout, sys.stderr] if hasattr(x, 'fileno')]
+        exclude.append(self._pidfd)
         for fd in reversed(range(maxfd)):
             if fd not in exclude:
                 try:
@@ -240,17 +494,403 @@ class Daemon(object):
         sys.__stdin__ = sys.stdin
 
         sys.stdout.flush()
-        so = open(self.stdout, "a+", 0)
-        os.close(sys.stdout.fileno())
-        os.dup2(so.fileno(), sys.stdout.fileno())
+        self._redirect(self.stdout, sys.stdout.fileno(), LOG_INFO)
         sys.__stdout__ = sys.stdout
 
         sys.stderr.flush()
-        se = open(self.stderr, "a+", 0)
-        os.close(sys.stderr.fileno())
-        os.dup2(se.fileno(), sys.stderr.fileno())
+        self._redirect(self.stderr, sys.stderr.fileno(), LOG_ERR)
         sys.__stderr__ = sys.stderr
 
+        for name, ok, message in self.tuningreport:
+            sys.stderr.write('Tuning %s %s: %s\n' % (name, 'applied' if ok else 'failed', message))
+        sys.stderr.flush()
+
+        if self.stacksignal is not None:
+            import faulthandler
+            faulthandler.register(self.stacksignal, file=sys.stderr, all_threads=True)
+
+        # Rebuild the fork sensitive resources dropped after forking.
+        resources.registry.rebuild()
+
+        # Share the activity with worker processes, which report it too. This
+        # has to wait until the file descriptors are closed: multiprocessing
+        # keeps using those of its shared memory.
+        context = self._context()
+
+        with self._activelock:
+            self._lastactivity = context.RawValue('d', self._lastactivity.value)
+            self._active = context.RawValue('q', self._active.value)
+            self._activelock = context.Lock()
+
+        # Reap exited children.
+        if self.reapchildren:
+            self._reaper()
+
+        # Start the fork server while the process is still small.
+        if self.spawnmethod == 'forkserver':
+            from multiprocessing import forkserver
+            self._context()
+            forkserver.ensure_running()
+
+        # A standby does this in Daemon.activate, its files are still in use
+        # by the active instance.
+        self._started = True
+
+        if self.active:
+            self._activated()
+
+    def _activated(self):
+        if self.flightrecorder is not None:
+            self._start_recorder()
+
+        # Map the state left by the previous generation.
+        if self.statefile is not None:
+            from elib.daemon.state import StateArea
+            self.state = StateArea(self.statefile, self.stateversion)
+
+            if self.state.load() is None:
+                sys.stderr.write('Not using previous state: %s\n' % self.state.rejected)
+                sys.stderr.flush()
+
+            self.atshutdown(self.state.commit)
+
+        # Load and publish the initial configuration.
+        if self.loadconfig is not None:
+            from elib.daemon.config import ConfigChannel
+            self.config = ConfigChannel(os.path.join(self._configdir(), 'config'), self._context())
+
+            if not self.reload():
+                os._exit(os.EX_CONFIG)
+
+        # Watch for inactivity.
+        if self.idletimeout is not None:
+            self.touch()
+            self.every(min(self.idletimeout / 4.0, 5.0), self._idle, name='idle')
+
+    def run(self, main):
+        '''
+        Daemonize the running script and run `main` on an asyncio event loop
+        until it completes or the daemon is told to terminate.
+
+        The event loop is provided by uvloop when it is installed. The signals
+        in `sigmap` are dispatched through `loop.add_signal_handler`, so their
+        callbacks run from the event loop instead of interrupting it. The
+        default `SIGTERM` callback cancels `main` instead of raising
+        `SystemExit`. Readiness is not announced by `run` itself: `main`
+        awaits `Daemon.ready` once it is ready to serve, from within the
+        loop. A standby first waits to become active, see `Daemon.activate`.
+        When `main` is done or raised, `Daemon.shutdown` is called, remaining
+        tasks are cancelled, asynchronous generators and the default executor
+        are shut down and the loop is closed.
+
+        :param main: a coroutine object or a coroutine function taking no
+                     arguments.
+        :returns: the return value of `main`, or None when it was cancelled.
+        '''
+        import asyncio
+
+        from elib.daemon import resources
+
+        self.start()
+
+        if not self.active:
+            resources.registry.prewarm()
+            self.activate()
+
+        try:
+            import uvloop
+        except ImportError:
+            loop = asyncio.new_event_loop()
+        else:
+            loop = uvloop.new_event_loop()
+
+        asyncio.set_event_loop(loop)
+
+        try:
+            if not asyncio.iscoroutine(main):
+                main = main()
+
+            task = loop.create_task(main)
+
+            for signum, callback in self.sigmap.items():
+                if callback == self._terminate:
+                    loop.add_signal_handler(signum, task.cancel)
+                else:
+                    loop.add_signal_handler(signum, callback, signum, None)
+
+            try:
+                result = loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                result = None
+
+            return result
+        finally:
+            # Also when `main` raised: workers, the scheduler and the state
+            # must not outlive it.
+            self.shutdown()
+
+            try:
+                tasks = asyncio.all_tasks(loop)
+
+                for task in tasks:
+                    task.cancel()
+
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.run_until_complete(loop.shutdown_default_executor())
+            finally:
+                for signum in self.sigmap:
+                    loop.remove_signal_handler(signum)
+
+                asyncio.set_event_loop(None)
+                loop.close()
+
+    async def ready(self):
+        '''
+        Announce readiness from a coroutine running on the event loop of
+        `Daemon.run`, typically `main` once its servers are listening. Like
+        `Daemon.notify_ready`, which it calls, this pre-warms the resources
+        first; pre-warm functions run on the loop and can use it.
+        '''
+        self.notify_ready()
+
+    def notify_ready(self):
+        '''
+        Tell the service manager that the daemon has finished starting up.
+        Resources registered with `elib.daemon.resources` are pre-warmed
+        first. When the `NOTIFY_SOCKET` environment variable is set (as it is
+        for systemd services of `Type=notify`), `READY=1` is then sent to that
+        socket.
+        '''
+        import socket
+
+        from elib.daemon import resources
+
+        resources.registry.prewarm()
+
+        address = os.environ.get('NOTIFY_SOCKET')
+
+        if not address:
+            return
+
+        if address.startswith('@'):
+            # Abstract namespace socket
+            address = '\0' + address[1:]
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        try:
+            sock.connect(address)
+            sock.sendall(('READY=1\nMAINPID=%d\n' % os.getpid()).encode('ascii'))
+        finally:
+            sock.close()
+
+    def activate(self, block=True):
+        '''
+        Make this instance the active one by locking the pidfile and writing
+        our pid to it. A standby instance blocks until the active instance
+        releases the lock, which the kernel does the moment it exits. The
+        flight recorder, state area, configuration and idle timeout of a
+        standby are only set up once it is active.
+
+        :param block: wait for the lock. This argument is optional and
+                      defaults to True.
+        :returns: True when this instance is active.
+        '''
+        import fcntl
+
+        if self.active:
+            return True
+
+        while True:
+            try:
+                fcntl.lockf(self._pidfd, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+
+            # The lock is worthless when the pid file was removed or replaced
+            # while we waited: lock the file now at the path instead.
+            try:
+                if os.path.samestat(os.fstat(self._pidfd), os.stat(self.pidfile)):
+                    break
+            except FileNotFoundError:
+                pass
+
+            os.close(self._pidfd)
+            self._pidfd = os.open(self.pidfile, os.O_RDWR | os.O_CREAT, 0o644)
+
+        os.ftruncate(self._pidfd, 0)
+        os.lseek(self._pidfd, 0, os.SEEK_SET)
+        os.write(self._pidfd, str(os.getpid()).encode('ascii'))
+        self.active = True
+
+        if self.standby:
+            try:
+                os.remove(self.pidfile + '.standby')
+            except OSError:
+                pass
+
+        if self._started:
+            self._activated()
+
+        if self.recorder is not None:
+            self.recorder.record('Active with pid %d' % os.getpid())
+
+        return True
+
+    def spawn(self, target, args=(), kwargs=None, name=None):
+        '''
+        Start a worker process running `target(*args, **kwargs)`, using the
+        method selected with the `spawn` argument of the constructor.
+
+        With the `forkserver` and `exec` methods `target` and its arguments
+        are pickled, so `target` must be importable by name, and the main
+        module is imported again by the new interpreter.
+
+        :returns: the started `multiprocessing.Process`.
+        '''
+        process = self._context().Process(target=target, args=args, kwargs=kwargs or {}, name=name)
+        process.start()
+        return process
+
+    def reload(self):
+        '''
+        Load the configuration with the `loadconfig` callable passed to the
+        constructor and, if that succeeds, publish it to all processes
+        through `Daemon.config`. When loading or publishing fails the error
+        is written to stderr and the current configuration stays in effect.
+
+        :returns: True when a new configuration was published.
+        '''
+        try:
+            config = self.loadconfig()
+        except Exception as e:
+            sys.stderr.write('Failed to load configuration: %s\n' % e)
+            sys.stderr.flush()
+            return False
+
+        try:
+            self.config.publish(config)
+        except Exception as e:
+            sys.stderr.write('Failed to publish configuration: %s\n' % e)
+            sys.stderr.flush()
+            return False
+
+        return True
+
+    def every(self, interval, function, jitter=0, name=None, delay=None):
+        '''
+        Call `function` without arguments every `interval` seconds from the
+        daemon's `elib.daemon.scheduler.Scheduler`, available as
+        `Daemon.scheduler`. The scheduler is started on first use, in the
+        calling process, and stopped by `Daemon.shutdown`. See
+        `elib.daemon.scheduler.Scheduler.every` for the arguments.
+
+        :returns: the new `elib.daemon.scheduler.Job`.
+        '''
+        if self.scheduler is None:
+            from elib.daemon.scheduler import Scheduler
+            self.scheduler = Scheduler()
+            self.scheduler.start()
+            self.atshutdown(self.scheduler.stop)
+
+        return self.scheduler.every(interval, function, jitter, name, delay)
+
+    def workers(self, target, processes=None, threads=None, args=(), listen=None):
+        '''
+        Start a `elib.daemon.workers.WorkerPool` running `target` in
+        `processes` worker processes with `threads` threads each. Missing
+        layout values get defaults suited to the interpreter, see
+        `elib.daemon.workers.layout`. Dead worker processes are replaced
+        every second and the pool is stopped by `Daemon.shutdown`.
+
+        With a `listen` socket the daemon accepts the connections and hands
+        each to the worker process with the fewest requests in flight, see
+        `elib.daemon.dispatch`.
+
+        :returns: the started `elib.daemon.workers.WorkerPool`.
+        '''
+        from elib.daemon.workers import WorkerPool
+
+        pool = WorkerPool(self, target, processes, threads, args, listen)
+        pool.start()
+        self._pools.append(pool)
+        self.every(1.0, pool.supervise, name='workers')
+        self.atshutdown(pool.stop)
+        return pool
+
+    def subprocesses(self, maxprocesses=8, timeout=None):
+        '''
+        Create a `elib.daemon.children.SubprocessPool` running at most
+        `maxprocesses` commands at the same time, each with a default timeout
+        of `timeout` seconds. The pool uses `Daemon.reaper`, which is
+        started on first use and stopped by `Daemon.shutdown`.
+        '''
+        from elib.daemon.children import SubprocessPool
+        return SubprocessPool(self._reaper(), maxprocesses, timeout)
+
+    def touch(self):
+        '''
+        Report activity, restarting the idle timeout. Like `Daemon.acquire`
+        and `Daemon.release` this can be called from worker processes
+        started with the `fork` method after `Daemon.start`.
+        '''
+        self._lastactivity.value = time.monotonic()
+
+    def acquire(self):
+        '''
+        Report the start of an activity lasting some time, for example an
+        accepted connection. The daemon is not idle until every
+        `Daemon.acquire` is matched by a `Daemon.release`.
+        '''
+        with self._activelock:
+            self._active.value += 1
+
+    def release(self):
+        '''
+        Report the end of an activity started with `Daemon.acquire`.
+        '''
+        with self._activelock:
+            self._active.value -= 1
+            self._lastactivity.value = time.monotonic()
+
+    def atshutdown(self, callback):
+        '''
+        Register `callback`, a callable without arguments, to be called by
+        `Daemon.shutdown`. Callbacks are called in reverse order of
+        registration.
+        '''
+        self._shutdownhooks.append(callback)
+
+    def shutdown(self):
+        '''
+        Gracefully shut down the daemon by calling the callbacks registered
+        with `Daemon.atshutdown`. This is done by the default `SIGTERM`
+        handler and by `Daemon.run`; applications with their own termination
+        handler should call it themselves. Only the first call has any effect.
+        '''
+        if self._shutdown:
+            return
+
+        self._shutdown = True
+
+        for callback in reversed(self._shutdownhooks):
+            try:
+                callback()
+            except Exception as e:
+                sys.stderr.write('Shutdown callback %r failed: %s\n' % (callback, e))
+                sys.stderr.flush()
+
+        # Whoever starts us on demand must not find a stale pidfile. It is
+        # emptied instead of removed: a standby may be waiting for its lock.
+        if self._idleexit and self.active:
+            try:
+                os.ftruncate(self._pidfd, 0)
+            except OSError:
+                pass
+
     def stop(self):
         '''
         Sends a SIGTERM signal to the running daemon, if any. The pid of the
@@ -262,12 +902,18 @@ class Daemon(object):
             sys.exit('Error: pid file \'%s\' does not exist' % self.pidfile)
 
         try:
-            with open(self.pidfile, 'rb') as f:
-                pid = int(f.read().strip())
+            data = self._readpid().strip()
         except IOError as e:
             sys.exit('Error: can\'t open pidfile %s: %s' % (self.pidfile, str(e)))
+
+        if not data:
+            # emptied by an idle exit -> not running
+            return
+
+        try:
+            pid = int(data)
         except ValueError:
-            sys.exit('Error: mangled pidfile %s: %r' % self.pidfile)
+            sys.exit('Error: mangled pidfile %s: %r' % (self.pidfile, data))
 
         try:
             os.kill(pid, signal.SIGTERM)
@@ -275,5 +921,147 @@ class Daemon(object):
             # process already disappeared -> ignore
             pass
 
+    def _configdir(self):
+        name = os.path.splitext(os.path.basename(self.pidfile))[0]
+        return os.path.join(os.path.dirname(self.pidfile), '%s.config.d' % name)
+
+    def _readpid(self):
+        # Closing any descriptor of the pid file releases the daemon's lock on
+        # it, so the daemon reads it through the one it holds.
+        if self._pidfd is not None:
+            return os.pread(self._pidfd, 64, 0)
+
+        with open(self.pidfile, 'rb') as f:
+            return f.read()
+
+    def _mapsignal(self, signum, callback):
+        if signum in self.sigmap:
+            raise ValueError('signal %s is already in use' % signum)
+
+        self.sigmap[signum] = callback
+
+    def _context(self):
+        if self._mpcontext is None:
+            import multiprocessing
+            self._mpcontext = multiprocessing.get_context(SPAWN[self.spawnmethod])
+
+            if self.spawnmethod == 'forkserver' and self.preload:
+                self._mpcontext.set_forkserver_preload(self.preload)
+
+        return self._mpcontext
+
+    def _redirect(self, target, fd, priority):
+        from elib.daemon import logsink
+
+        address = logsink.parse(target)
+
+        if address is None:
+            f = open(target, "ab+", 0)
+            os.close(fd)
+            os.dup2(f.fileno(), fd)
+        else:
+            sink = logsink.LogSink(address[0], address[1], priority)
+            sink.redirect(fd)
+
+            def close():
+                # Output still buffered at exit must reach the sink.
+                sys.stdout.flush()
+                sys.stderr.flush()
+                sink.close()
+
+            atexit.register(close)
+
+    def _start_recorder(self):
+        import faulthandler
+        import logging
+        from elib.daemon.flightrecorder import FlightRecorder, FlightRecorderHandler
+
+        self.recorder = FlightRecorder(self.flightrecorder)
+        self._crashfile = self.recorder.crashfile()
+        faulthandler.enable(file=self._crashfile, all_threads=True)
+        self._recorderhandler = FlightRecorderHandler(self.recorder)
+        logging.getLogger().addHandler(self._recorderhandler)
+        os.register_at_fork(after_in_child=self._detach_recorder)
+        self.recorder.record('Daemon started with pid %d' % os.getpid())
+
+    def _detach_recorder(self):
+        import faulthandler
+        import logging
+
+        # Forked workers do not write into the daemon's flight recorder, their
+        # fatal errors go to stderr instead of the daemon's crash area.
+        logging.getLogger().removeHandler(self._recorderhandler)
+        faulthandler.enable(file=sys.stderr, all_threads=True)
+        self._crashfile.close()
+
+    def _idle(self):
+        # Requests handled by worker pools count as activity.
+        for pool in self._pools:
+            if pool.busy():
+                self.touch()
+
+        with self._activelock:
+            if self._active.value or time.monotonic() - self._lastactivity.value < self.idletimeout:
+                return
+
+        if not self._idleexit:
+            self._idleexit = True
+            sys.stderr.write('Idle for %s seconds, exiting\n' % self.idletimeout)
+            sys.stderr.flush()
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _reaper(self):
+        if self.reaper is None:
+            from elib.daemon.children import Reaper
+            self.reaper = Reaper()
+            self.reaper.start()
+            self.atshutdown(self.reaper.stop)
+
+        return self.reaper
+
+    def _sigchld(self, signum, frame):
+        if self.reaper is not None:
+            self.reaper.wakeup()
+
+    def _reload(self, signum, frame):
+        self.reload()
+
     def _terminate(self, signum, frame):
+        if self.recorder is not None:
+            self.recorder.record('Terminating on signal %s' % signum)
+
+        self.shutdown()
         sys.exit('Terminating on signal %s' % signum)
+
+    def _diagnostics_path(self, directory, kind, extension):
+        name = os.path.splitext(os.path.basename(self.pidfile))[0]
+        timestamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(directory, '%s-%s-%d-%s.%s' % (name, kind, os.getpid(), timestamp, extension))
+
+    def _profile(self, signum, frame):
+        from elib.daemon.diagnostics import StackSampler
+
+        if self._sampler is not None and self._sampler.running():
+            sys.stderr.write('Profiler already running, ignoring signal %s\n' % signum)
+            sys.stderr.flush()
+            return
+
+        # Profiles go next to the stderr log, if there is one.
+        if os.path.isfile(self.stderr):
+            directory = os.path.dirname(os.path.abspath(self.stderr))
+        else:
+            directory = self.workdir
+
+        self._sampler = StackSampler(self._diagnostics_path(directory, 'profile', 'folded'), self.profileseconds)
+        self._sampler.start()
+
+    def _memory(self, signum, frame):
+        from elib.daemon.diagnostics import MemoryTracer
+
+        if self._tracer is None:
+            self._tracer = MemoryTracer(self.memoryframes)
+
+        if not self._tracer.tracing():
+            self._tracer.start()
+        else:
+            self._tracer.snapshot(self._diagnostics_path(self.workdir, 'memory', 'txt'))
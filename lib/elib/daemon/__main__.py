@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+
+'''
+Control running daemons from the command line, see `elib.daemon.control`.
+'''
+
+
+import sys
+
+from elib.daemon import control
+
+
+sys.exit(control.main(['python -m elib.daemon'] + sys.argv[1:]))
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.children module waits for child processes without polling.
+
+A `Reaper` runs a single thread that waits for all watched children at once.
+On Linux 5.3 and later every child is represented by a pidfd that becomes
+readable when the child exits; elsewhere the thread wakes up on `SIGCHLD`
+(see `Reaper.wakeup`) and at least every `POLL` seconds. Exit statuses are
+delivered to `concurrent.futures.Future` objects and optional callbacks.
+
+`SubprocessPool` builds on a `Reaper` to run commands with a concurrency
+limit and a timeout.
+'''
+
+
+__all__ = ['Reaper', 'SubprocessPool']
+__docformat__ = 'restructuredtext'
+
+
+import collections
+import errno
+import heapq
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+POLL = 0.1       # Seconds between checks for exited children without pidfd support.
+
+
+def _children():
+    # Return the pids of the children of this process, or None when /proc
+    # cannot tell.
+    try:
+        pids = set()
+
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/%s/children' % task) as f:
+                pids.update(int(pid) for pid in f.read().split())
+
+        return pids
+    except (IOError, OSError):
+        pass
+
+    # Kernels without /proc/<pid>/task/<tid>/children: look for processes
+    # whose parent we are.
+    try:
+        names = os.listdir('/proc')
+    except (IOError, OSError):
+        return None
+
+    parent = os.getpid()
+    pids = set()
+
+    for name in names:
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % name, 'rb') as f:
+                if int(f.read().rsplit(b')', 1)[1].split()[1]) == parent:
+                    pids.add(int(name))
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+
+    return pids
+
+
+class _Child(object):
+    def __init__(self, pid, future, popen, args, timeout):
+        self.pid = pid
+        self.future = future
+        self.popen = popen
+        self.args = args
+        self.timeout = timeout
+        self.timedout = False
+        self.pidfd = None
+
+
+class Reaper(object):
+    '''
+    The `elib.daemon.children.Reaper` class delivers the exit status of child
+    processes to futures.
+    '''
+    def __init__(self, reapall=False):
+        '''
+        :param reapall: also reap children that were not passed to
+                        `Reaper.watch`, so they do not stay behind as
+                        zombies. Children started by `multiprocessing` are
+                        left alone. This is dangerous: it also reaps
+                        children the application waits for itself, with
+                        `subprocess` or `asyncio` for example, which then
+                        get a return code of 0 whatever the child's exit
+                        status was. Only use it in a process that starts
+                        no children other than through the reaper.
+                        This argument is optional and defaults to False.
+        '''
+        self.reapall = reapall
+
+        self._lock = threading.Lock()
+        self._children = {}
+        self._deadlines = []
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self._pidfd = hasattr(os, 'pidfd_open')
+        self._spawning = 0
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        '''
+        Start the thread waiting for children.
+        '''
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='elib.daemon.Reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop the thread waiting for children. Children still being watched
+        are not waited for anymore.
+        '''
+        if self._thread is not None:
+            self._stopping = True
+            self.wakeup()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wakeup(self):
+        '''
+        Make the reaper check for exited children. This is safe to call from a
+        signal handler, for example for `SIGCHLD`.
+        '''
+        try:
+            os.write(self._wakeup[1], b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def watch(self, pid, callback=None, timeout=None, popen=None):
+        '''
+        Wait for child process `pid` to exit.
+
+        :param callback: callable receiving the future when it is done.
+                         This argument is optional and defaults to None.
+        :param timeout: number of seconds after which the child is killed with
+                        `SIGKILL`; the future then fails with
+                        `subprocess.TimeoutExpired`.
+                        This argument is optional and defaults to None.
+        :param popen: the `subprocess.Popen` object of the child, if any. Its
+                      `returncode` is set when the child is reaped.
+        :returns: a `concurrent.futures.Future` whose result is the return
+                  code of the child, negative when it was killed by a signal.
+        '''
+        future = Future()
+
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        args = popen.args if popen is not None else pid
+        child = _Child(pid, future, popen, args, timeout)
+
+        with self._lock:
+            self._children[pid] = child
+
+            if self._pidfd:
+                try:
+                    child.pidfd = os.pidfd_open(pid)
+                except OSError as e:
+                    if e.errno != errno.ENOSYS:
+                        del self._children[pid]
+                        future.set_exception(e)
+                        return future
+
+                    self._pidfd = False
+                else:
+                    self._selector.register(child.pidfd, selectors.EVENT_READ, child)
+
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (time.monotonic() + timeout, pid, child))
+
+        self.wakeup()
+        return future
+
+    def spawn(self, args, callback=None, timeout=None, **kwargs):
+        '''
+        Start `args` with `subprocess.Popen` and watch it. Keyword arguments
+        are passed on to `subprocess.Popen`. Arguments are as for
+        `Reaper.watch`.
+
+        :returns: a `concurrent.futures.Future` whose result is the return
+                  code of the command.
+        '''
+        # Keep reapall from reaping the child before it is watched.
+        with self._lock:
+            self._spawning += 1
+
+        try:
+            popen = subprocess.Popen(args, **kwargs)
+            return self.watch(popen.pid, callback, timeout, popen)
+        finally:
+            with self._lock:
+                self._spawning -= 1
+
+    def _reap(self, pid):
+        try:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            self._done(pid, None)
+        else:
+            if wpid != 0:
+                self._done(pid, os.waitstatus_to_exitcode(status))
+
+    def _done(self, pid, returncode):
+        with self._lock:
+            child = self._children.pop(pid, None)
+
+            if child is None:
+                return
+
+            if child.pidfd is not None:
+                self._selector.unregister(child.pidfd)
+                os.close(child.pidfd)
+
+        if child.popen is not None and returncode is not None:
+            child.popen.returncode = returncode
+
+        if child.timedout:
+            child.future.set_exception(subprocess.TimeoutExpired(child.args, child.timeout))
+        elif returncode is None:
+            child.future.set_exception(ChildProcessError(errno.ECHILD, 'child %d was reaped elsewhere' % pid))
+        else:
+            child.future.set_result(returncode)
+
+    def _reap_unwatched(self):
+        ignore = set()
+
+        if 'multiprocessing' in sys.modules:
+            from multiprocessing import process
+            ignore.update(p.pid for p in process._children)
+
+        children = _children()
+
+        if children is not None:
+            # Waiting per pid: waitid(P_ALL) keeps returning the same child
+            # when it has to be left alone, hiding the others.
+            for pid in children - ignore:
+                if pid in self._children:
+                    self._reap(pid)
+                else:
+                    try:
+                        os.waitpid(pid, os.WNOHANG)
+                    except ChildProcessError:
+                        pass
+
+            return
+
+        while True:
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                return
+
+            if info is None or info.si_pid in ignore:
+                return
+
+            if info.si_pid in self._children:
+                self._reap(info.si_pid)
+            else:
+                try:
+                    os.waitpid(info.si_pid, 0)
+                except ChildProcessError:
+                    pass
+
+    def _expire(self):
+        now = time.monotonic()
+
+        with self._lock:
+            expired = []
+
+            while self._deadlines and self._deadlines[0][0] <= now:
+                expired.append(heapq.heappop(self._deadlines)[2])
+
+        for child in expired:
+            if child.pid in self._children:
+                child.timedout = True
+
+                try:
+                    os.kill(child.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def _run(self):
+        while not self._stopping:
+            with self._lock:
+                timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+
+            if not self._pidfd and self._children:
+                timeout = POLL if timeout is None else min(timeout, POLL)
+
+            for key, event in self._selector.select(None if timeout is None else max(timeout, 0)):
+                if key.fd == self._wakeup[0]:
+                    os.read(self._wakeup[0], 4096)
+                else:
+                    self._reap(key.data.pid)
+
+            self._expire()
+
+            if not self._pidfd:
+                for pid in list(self._children):
+                    self._reap(pid)
+
+            if self.reapall and not self._spawning:
+                self._reap_unwatched()
+
+
+class SubprocessPool(object):
+    '''
+    The `elib.daemon.children.SubprocessPool` class runs commands with a
+    limit on the number running at the same time.
+    '''
+    def __init__(self, reaper, maxprocesses=8, timeout=None):
+        '''
+        :param reaper: a started `Reaper`.
+        :param maxprocesses: maximum number of commands running at the same
+                             time, others wait in a queue.
+                             This argument is optional and defaults to 8.
+        :param timeout: default timeout in seconds for each command, counted
+                        from the moment it starts running.
+                        This argument is optional and defaults to None.
+        '''
+        self.reaper = reaper
+        self.maxprocesses = maxprocesses
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queue = collections.deque()
+
+    def submit(self, args, timeout=None, **kwargs):
+        '''
+        Run `args` with `subprocess.Popen` as soon as there is room. Keyword
+        arguments are passed on to `subprocess.Popen`.
+
+        :param timeout: timeout in seconds for this command.
+                        This argument is optional and defaults to the timeout
+                        of the pool.
+        :returns: a `concurrent.futures.Future` whose result is the return
+                  code of the command.
+        '''
+        future = Future()
+        job = (args, self.timeout if timeout is None else timeout, kwargs, future)
+
+        with self._lock:
+            if self._running >= self.maxprocesses:
+                self._queue.append(job)
+                return future
+
+            self._running += 1
+
+        self._start(job)
+        return future
+
+    def _start(self, job):
+        while True:
+            args, timeout, kwargs, future = job
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    self.reaper.spawn(args, self._finished(future), timeout, **kwargs)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    return
+
+            # The job was cancelled or failed to start, move on to the next.
+            with self._lock:
+                if not self._queue:
+                    self._running -= 1
+                    return
+
+                job = self._queue.popleft()
+
+    def _finished(self, future):
+        def callback(done):
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+            with self._lock:
+                if not self._queue:
+                    self._running -= 1
+                    return
+
+                job = self._queue.popleft()
+
+            self._start(job)
+
+        return callback
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.config module broadcasts configuration to worker processes.
+
+The daemon publishes a new configuration by writing it to a file, replacing
+the previous one atomically, and then increasing a version number kept in
+shared memory. Workers call `ConfigChannel.current` at a point where swapping
+configuration is safe, typically before handling a request. As long as the
+version did not change this only reads the shared counter; otherwise the new
+configuration is loaded once and returned from then on.
+'''
+
+
+__all__ = ['ConfigChannel']
+__docformat__ = 'restructuredtext'
+
+
+import os
+import pickle
+
+
+class ConfigChannel(object):
+    '''
+    The `elib.daemon.config.ConfigChannel` class holds the current version
+    of a configuration shared between the daemon and its workers. Pass it to
+    workers as an argument of `Daemon.spawn`.
+    '''
+    def __init__(self, path, context=None):
+        '''
+        :param path: file name the published configuration is stored in.
+        :param context: `multiprocessing` context used to allocate the shared
+                        version counter. This argument is optional and
+                        defaults to the default context.
+        '''
+        if context is None:
+            import multiprocessing as context
+
+        self.path = path
+        self._version = context.RawValue('Q', 0)
+        self._current = (0, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_current'] = (0, None)
+        return state
+
+    @property
+    def version(self):
+        '''
+        Version number of the most recently published configuration, 0 when
+        nothing was published yet.
+        '''
+        return self._version.value
+
+    def publish(self, config):
+        '''
+        Make `config` the current configuration of all processes sharing this
+        channel. `config` must be picklable.
+        '''
+        version = self._version.value + 1
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+
+        with open(tmp, 'wb') as f:
+            pickle.dump((version, config), f, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp, self.path)
+        self._version.value = version
+
+    def current(self):
+        '''
+        Return the current configuration, loading it first when a new version
+        was published since the last call.
+        '''
+        if self._current[0] != self._version.value:
+            with open(self.path, 'rb') as f:
+                self._current = pickle.load(f)
+
+        return self._current[1]
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.control module controls running daemons through their pid
+files, without importing any application code. It is the implementation of
+the `python -m elib.daemon` command::
+
+    python -m elib.daemon [options] status|stop|restart-wait PIDFILE...
+    python -m elib.daemon [options] signal SIGNAL PIDFILE...
+    python -m elib.daemon [options] tail-log [PIDFILE [LOGFILE]]
+
+Instead of pid files on the command line, `--manifest` names a file listing
+one pid file per line, optionally followed by the log file of that daemon.
+Empty lines and lines starting with `#` are ignored. `tail-log` shows the log
+file of the only daemon given, or with a manifest that of PIDFILE.
+
+`status` exits with 0 when all daemons are running, 1 when a pid file names
+a process that is gone and 3 when a daemon is not running, like the LSB init
+script actions. The other commands exit with 1 when they fail for any of the
+daemons.
+
+The same commands are installed as the `elib-daemon` script, which loads
+this module without importing the elib namespace package. Its pkg_resources
+based __init__ costs many times a status check, so use the script for
+sweeps over many hosts. Only modules that are cheap to import are imported up
+front: through the script a status sweep costs little more than starting the
+interpreter, see `benchmarks/control`.
+'''
+
+
+__all__ = ['Status', 'readpid', 'alive', 'status', 'wait', 'waitpid', 'signum', 'tail', 'main']
+__docformat__ = 'restructuredtext'
+
+
+import errno
+import os
+import signal
+import sys
+import time
+
+
+POLL = 0.05      # Seconds between checks when the kernel cannot notify us.
+
+RUNNING = 0      # LSB status codes
+DEAD = 1
+STOPPED = 3
+
+
+class Status(object):
+    '''
+    The `elib.daemon.control.Status` class describes the state of the daemon
+    owning a pid file.
+    '''
+    def __init__(self, pidfile, pid, running, standby):
+        #: name of the pid file
+        self.pidfile = pidfile
+        #: pid read from the pid file, or None
+        self.pid = pid
+        #: True when `pid` is a running process
+        self.running = running
+        #: pid of a running standby instance, or None
+        self.standby = standby
+
+    @property
+    def code(self):
+        '''
+        The LSB status code: 0 when running, 1 when the pid file names a
+        process that is gone and 3 when not running.
+        '''
+        if self.running:
+            return RUNNING
+        elif self.pid is not None:
+            return DEAD
+
+        return STOPPED
+
+    def __str__(self):
+        if self.running:
+            text = 'running (pid %d)' % self.pid
+        elif self.pid is not None:
+            text = 'dead (stale pid %d)' % self.pid
+        else:
+            text = 'not running'
+
+        if self.standby is not None:
+            text += ', standby (pid %d)' % self.standby
+
+        return '%s: %s' % (self.pidfile, text)
+
+
+def readpid(pidfile):
+    '''
+    Read the pid from `pidfile`.
+
+    :returns: the pid, or None when the file does not exist, is empty or
+              does not hold a pid.
+    '''
+    try:
+        with open(pidfile, 'rb') as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def alive(pid):
+    '''
+    Return True when process `pid` exists.
+    '''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # The process exists but belongs to somebody else.
+        return e.errno == errno.EPERM
+
+    # A zombie has exited already, it only waits for its parent to reap it.
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            return f.read().rsplit(b')', 1)[1].split()[0] != b'Z'
+    except (IOError, OSError, IndexError):
+        return True
+
+
+def status(pidfile):
+    '''
+    Return the `Status` of the daemon owning `pidfile`.
+    '''
+    pid = readpid(pidfile)
+    standby = readpid(pidfile + '.standby')
+
+    if standby is not None and not alive(standby):
+        standby = None
+
+    return Status(pidfile, pid, pid is not None and alive(pid), standby)
+
+
+def waitpid(pid, timeout):
+    '''
+    Wait up to `timeout` seconds for process `pid`, which does not have to
+    be our child, to exit.
+
+    :returns: True when the process is gone.
+    '''
+    deadline = time.monotonic() + timeout
+
+    if hasattr(os, 'pidfd_open'):
+        try:
+            fd = os.pidfd_open(pid)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return True
+        else:
+            import select
+
+            try:
+                return bool(select.select([fd], [], [], max(timeout, 0))[0])
+            finally:
+                os.close(fd)
+
+    while alive(pid):
+        if time.monotonic() >= deadline:
+            return False
+
+        time.sleep(POLL)
+
+    return True
+
+
+def wait(pidfile, timeout, exclude=None):
+    '''
+    Wait up to `timeout` seconds for `pidfile` to name a running process
+    other than `exclude`.
+
+    :returns: the pid of that process, or None.
+    '''
+    deadline = time.monotonic() + timeout
+
+    while True:
+        pid = readpid(pidfile)
+
+        if pid is not None and pid != exclude and alive(pid):
+            return pid
+
+        if time.monotonic() >= deadline:
+            return None
+
+        time.sleep(POLL)
+
+
+def signum(name):
+    '''
+    Return the number of the signal called `name`, which may be a number
+    or a name with or without the `SIG` prefix.
+    '''
+    if name.isdigit():
+        return int(name)
+
+    name = name.upper()
+
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+
+    number = getattr(signal, name, None)
+
+    if not isinstance(number, int) or name.startswith('SIG_'):
+        raise ValueError('unknown signal %s' % name)
+
+    return int(number)
+
+
+def tail(logfile, lines=10, follow=False, out=None):
+    '''
+    Write the last `lines` lines of `logfile` to `out`. With `follow`, keep
+    writing lines appended to it, reopening the file when it is rotated or
+    truncated, until interrupted.
+
+    :param out: a binary file.
+                This argument is optional and defaults to stdout.
+    '''
+    if out is None:
+        out = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+
+    f = open(logfile, 'rb')
+
+    try:
+        # Read blocks backwards from the end until there are enough lines.
+        size = end = f.seek(0, os.SEEK_END)
+        data = b''
+
+        while end > 0 and data.count(b'\n') <= lines:
+            start = max(0, end - 8192)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+
+        out.write(b''.join(data.splitlines(True)[-lines:]) if lines > 0 else b'')
+        out.flush()
+        f.seek(size)
+
+        while follow:
+            data = f.read()
+
+            if data:
+                out.write(data)
+                out.flush()
+                continue
+
+            time.sleep(POLL * 5)
+
+            try:
+                st = os.stat(logfile)
+            except OSError:
+                continue
+
+            if st.st_ino != os.fstat(f.fileno()).st_ino:
+                # Rotated: finish the old file, then continue with the new one.
+                out.write(f.read())
+                f.close()
+                f = open(logfile, 'rb')
+            elif st.st_size < f.tell():
+                f.seek(0)
+    finally:
+        f.close()
+
+
+def _manifest(filename):
+    entries = []
+
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+
+            if line and not line.startswith('#'):
+                fields = line.split()
+                entries.append((fields[0], fields[1] if len(fields) > 1 else None))
+
+    return entries
+
+
+def _usage(args):
+    sys.stderr.write('Usage: %s [options] status|stop|restart-wait PIDFILE...\n'
+                     '       %s [options] signal SIGNAL PIDFILE...\n'
+                     '       %s [options] tail-log [PIDFILE [LOGFILE]]\n'
+                     '\n'
+                     'Options:\n'
+                     '  -m, --manifest FILE  read "PIDFILE [LOGFILE]" lines from FILE\n'
+                     '  -t, --timeout SECS   seconds to wait for stop and restart-wait [10]\n'
+                     '  -s, --signal SIGNAL  signal sent by stop and restart-wait [TERM]\n'
+                     '  -e, --exec COMMAND   restart-wait: start COMMAND once the old process exited\n'
+                     '  -n, --lines N        tail-log: number of lines to show [10]\n'
+                     '  -f, --follow         tail-log: keep showing new lines\n' % (args[0], args[0], args[0]))
+    return 2
+
+
+def _parse(args):
+    # A hand-rolled parser: optparse and argparse alone cost more than the
+    # rest of a status check.
+    options = {'manifest': None, 'timeout': 10.0, 'signal': 'TERM', 'exec': None, 'lines': 10, 'follow': False}
+    names = {'-m': 'manifest', '--manifest': 'manifest',
+             '-t': 'timeout', '--timeout': 'timeout',
+             '-s': 'signal', '--signal': 'signal',
+             '-e': 'exec', '--exec': 'exec',
+             '-n': 'lines', '--lines': 'lines'}
+    positional = []
+    rest = list(args)
+
+    while rest:
+        arg = rest.pop(0)
+
+        if arg == '--':
+            positional.extend(rest)
+            break
+        elif arg in ('-f', '--follow'):
+            options['follow'] = True
+        elif arg.split('=', 1)[0] in names:
+            name = names[arg.split('=', 1)[0]]
+
+            if '=' in arg:
+                value = arg.split('=', 1)[1]
+            elif rest:
+                value = rest.pop(0)
+            else:
+                raise ValueError('option %s needs a value' % arg)
+
+            options[name] = value
+        elif arg.startswith('-') and arg != '-':
+            raise ValueError('unknown option %s' % arg)
+        else:
+            positional.append(arg)
+
+    options['timeout'] = float(options['timeout'])
+    options['lines'] = int(options['lines'])
+    return options, positional
+
+
+def _stop(entry, number, timeout):
+    current = status(entry)
+
+    if not current.running:
+        sys.stdout.write('%s\n' % current)
+        return True
+
+    try:
+        os.kill(current.pid, number)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            sys.stderr.write('%s: cannot signal pid %d: %s\n' % (entry, current.pid, e.strerror))
+            return False
+
+    if not waitpid(current.pid, timeout):
+        sys.stderr.write('%s: pid %d did not exit within %s seconds\n' % (entry, current.pid, timeout))
+        return False
+
+    sys.stdout.write('%s: stopped (pid %d)\n' % (entry, current.pid))
+    return True
+
+
+def _restart(entry, number, timeout, command):
+    old = readpid(entry)
+    deadline = time.monotonic() + timeout
+
+    if old is not None and alive(old):
+        os.kill(old, number)
+
+        if not waitpid(old, timeout):
+            sys.stderr.write('%s: pid %d did not exit within %s seconds\n' % (entry, old, timeout))
+            return False
+
+    if command is not None:
+        import shlex
+        import subprocess
+
+        returncode = subprocess.call(shlex.split(command))
+
+        if returncode != 0:
+            sys.stderr.write('%s: %s exited with %d\n' % (entry, command, returncode))
+            return False
+
+    new = wait(entry, max(0, deadline - time.monotonic()), exclude=old)
+
+    if new is None:
+        sys.stderr.write('%s: no new process within %s seconds\n' % (entry, timeout))
+        return False
+
+    sys.stdout.write('%s: restarted (pid %s -> %d)\n' % (entry, old, new))
+    return True
+
+
+def main(args):
+    '''
+    Run the `python -m elib.daemon` or `elib-daemon` command with the command
+    line `args`.
+
+    :returns: the exit status.
+    '''
+    try:
+        options, positional = _parse(args[1:])
+    except ValueError as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return _usage(args)
+
+    if not positional:
+        return _usage(args)
+
+    command = positional.pop(0)
+
+    if command == 'signal':
+        if not positional:
+            return _usage(args)
+
+        options['signal'] = positional.pop(0)
+
+    try:
+        number = signum(options['signal'])
+    except ValueError as e:
+        sys.stderr.write('Error: %s\n' % e)
+        return 2
+
+    entries = [(pidfile, None) for pidfile in positional]
+
+    if options['manifest'] is not None:
+        try:
+            entries.extend(_manifest(options['manifest']))
+        except (IOError, OSError) as e:
+            sys.stderr.write('Error: cannot read manifest %s: %s\n' % (options['manifest'], e.strerror))
+            return 2
+
+    if command == 'tail-log':
+        if len(positional) == 2:
+            entries = [tuple(positional)]
+        elif len(positional) == 1 and options['manifest'] is not None:
+            # Pick the log file of PIDFILE from the manifest.
+            pidfile = os.path.abspath(positional[0])
+            entries = [entry for entry in entries[1:] if os.path.abspath(entry[0]) == pidfile]
+
+        if len(entries) != 1 or entries[0][1] is None:
+            sys.stderr.write('Error: tail-log needs exactly one daemon with a log file\n')
+            return 2
+
+        try:
+            tail(entries[0][1], options['lines'], options['follow'])
+        except (IOError, OSError) as e:
+            sys.stderr.write('Error: cannot read %s: %s\n' % (entries[0][1], e.strerror))
+            return 1
+        except KeyboardInterrupt:
+            pass
+
+        return 0
+
+    if not entries:
+        return _usage(args)
+
+    if command == 'status':
+        result = RUNNING
+
+        for pidfile, logfile in entries:
+            current = status(pidfile)
+            sys.stdout.write('%s\n' % current)
+            result = max(result, current.code)
+
+        return result
+
+    if command not in ('stop', 'restart-wait', 'signal'):
+        sys.stderr.write('Error: unknown command %s\n' % command)
+        return _usage(args)
+
+    failed = False
+
+    for pidfile, logfile in entries:
+        if command == 'stop':
+            failed |= not _stop(pidfile, number, options['timeout'])
+        elif command == 'restart-wait':
+            failed |= not _restart(pidfile, number, options['timeout'], options['exec'])
+        else:
+            current = status(pidfile)
+
+            if not current.running:
+                sys.stderr.write('%s\n' % current)
+                failed = True
+                continue
+
+            try:
+                os.kill(current.pid, number)
+            except OSError as e:
+                sys.stderr.write('%s: cannot signal pid %d: %s\n' % (pidfile, current.pid, e.strerror))
+                failed = True
+
+    sys.stdout.flush()
+    return 1 if failed else 0
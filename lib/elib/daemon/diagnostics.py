@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.diagnostics module contains tools to look inside a running
+daemon process without restarting it.
+'''
+
+
+__all__ = ['StackSampler', 'MemoryTracer']
+__docformat__ = 'restructuredtext'
+
+
+import gc
+import os
+import sys
+import threading
+import time
+
+
+class StackSampler(object):
+    '''
+    The `elib.daemon.diagnostics.StackSampler` class periodically records the
+    stacks of all threads in the current process and writes them in the
+    collapsed stack format understood by flamegraph.pl, speedscope and
+    similar tools: one line per unique stack, frames separated by `;`,
+    followed by the number of samples.
+    '''
+    def __init__(self, path, seconds=30, interval=0.01):
+        '''
+        :param path: file name the collapsed stacks are written to.
+        :param seconds: how long to sample.
+                        This argument is optional and defaults to 30.
+        :param interval: time between two samples in seconds.
+                         This argument is optional and defaults to 0.01.
+        '''
+        self.path = path
+        self.seconds = seconds
+        self.interval = interval
+        self._thread = None
+
+    def running(self):
+        '''
+        Return True while samples are being taken.
+        '''
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        '''
+        Start sampling in a background thread and return immediately.
+        '''
+        if self.running():
+            raise RuntimeError('sampler is already running')
+
+        self._thread = threading.Thread(target=self._run, name='elib.daemon.StackSampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        '''
+        Wait for the sampler to finish writing its output.
+        '''
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        me = threading.current_thread().ident
+        counts = {}
+        deadline = time.time() + self.seconds
+
+        while time.time() < deadline:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+
+            time.sleep(self.interval)
+
+        with open(self.path, 'w') as f:
+            for key, count in sorted(counts.items()):
+                f.write('%s %d\n' % (key, count))
+
+
+class MemoryTracer(object):
+    '''
+    The `elib.daemon.diagnostics.MemoryTracer` class takes `tracemalloc`
+    snapshots of the current process and reports how memory usage changed
+    between them.
+    '''
+    def __init__(self, frames=25, top=25):
+        '''
+        :param frames: number of frames `tracemalloc` stores per allocation.
+                       This argument is optional and defaults to 25.
+        :param top: number of entries listed in each section of a report.
+                    This argument is optional and defaults to 25.
+        '''
+        self.frames = frames
+        self.top = top
+        self._previous = None
+
+    def tracing(self):
+        '''
+        Return True when `tracemalloc` is tracing allocations.
+        '''
+        import tracemalloc
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        '''
+        Start tracing allocations. Only allocations made from now on show up
+        in snapshots.
+        '''
+        import tracemalloc
+        tracemalloc.start(self.frames)
+        self._previous = None
+
+    def stop(self):
+        '''
+        Stop tracing allocations and forget the previous snapshot.
+        '''
+        import tracemalloc
+        tracemalloc.stop()
+        self._previous = None
+
+    def snapshot(self, path):
+        '''
+        Write a report to `path` and the raw snapshot to `path` with a
+        `.tracemalloc` extension, which can be loaded with
+        `tracemalloc.Snapshot.load`. The report lists the top allocation
+        sites, the top differences against the previous snapshot, the
+        garbage collector generation counts and the object types using the
+        most memory.
+        '''
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, __file__),
+                                           tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                                           tracemalloc.Filter(False, '<unknown>')])
+        snapshot.dump(os.path.splitext(path)[0] + '.tracemalloc')
+
+        current, peak = tracemalloc.get_traced_memory()
+
+        with open(path, 'w') as f:
+            f.write('Traced memory: current %d bytes, peak %d bytes\n' % (current, peak))
+
+            f.write('\nTop %d allocation sites:\n' % self.top)
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                f.write('%s\n' % stat)
+
+            if self._previous is not None:
+                f.write('\nTop %d differences against the previous snapshot:\n' % self.top)
+                for stat in snapshot.compare_to(self._previous, 'lineno')[:self.top]:
+                    f.write('%s\n' % stat)
+
+            f.write('\nGarbage collector:\n')
+            f.write('counts: %s, thresholds: %s\n' % (gc.get_count(), gc.get_threshold()))
+            for generation, stats in enumerate(gc.get_stats()):
+                f.write('generation %d: %s\n' % (generation, stats))
+
+            f.write('\nTop %d object types by size:\n' % self.top)
+            sizes = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                count, size = sizes.get(name, (0, 0))
+                sizes[name] = (count + 1, size + sys.getsizeof(obj, 0))
+
+            for name, (count, size) in sorted(sizes.items(), key=lambda x: x[1][1], reverse=True)[:self.top]:
+                f.write('%s: %d objects, %d bytes\n' % (name, count, size))
+
+        self._previous = snapshot
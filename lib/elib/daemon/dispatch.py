@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.dispatch module hands connections accepted by the daemon to
+the least loaded worker process of a `elib.daemon.workers.WorkerPool`.
+
+When workers accept from a shared listening socket, or each from their own
+with `SO_REUSEPORT`, the kernel decides which worker gets a connection
+without knowing that one of them is stuck on a slow request. A `Dispatcher`
+instead accepts all connections in the daemon and sends each file descriptor
+(`SCM_RIGHTS`) over a Unix socket pair to the worker process with the fewest
+requests in flight and queued. Everything accepted in one wakeup is sent in
+one message per worker process, so the cost of the handoff is a few system
+calls per batch instead of a few per connection.
+
+In the worker process a `Receiver` thread queues the connections for the
+worker threads, which take them with `elib.daemon.workers.WorkerContext.accept`.
+'''
+
+
+__all__ = ['Dispatcher', 'Receiver']
+__docformat__ = 'restructuredtext'
+
+
+import errno
+import queue
+import select
+import selectors
+import socket
+import sys
+import threading
+import time
+
+
+BATCH = 64       # Default maximum number of connections accepted per wakeup.
+MAXFDS = 253     # Maximum number of file descriptors in one message (SCM_MAX_FD).
+POLL = 0.5       # Seconds between checks for the stop flag.
+BACKOFF = 0.01   # Seconds to wait when all worker channels are full.
+
+
+class Dispatcher(object):
+    '''
+    The `elib.daemon.dispatch.Dispatcher` class accepts connections in the
+    daemon and passes them to worker processes.
+    '''
+    def __init__(self, pool, listen, batch=BATCH):
+        '''
+        :param pool: the `elib.daemon.workers.WorkerPool` whose processes
+                     receive the connections.
+        :param listen: a listening `socket.socket`.
+        :param batch: maximum number of connections accepted before they are
+                      handed off.
+                      This argument is optional and defaults to 64.
+        '''
+        self.pool = pool
+        self.listen = listen
+        self.batch = batch
+
+        context = pool.daemon._context()
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET) for i in range(pool.processes)]
+        self.taken = context.RawArray('Q', pool.processes)
+        self.sent = [0] * pool.processes
+        #: number of connections handed to worker processes
+        self.dispatched = 0
+
+        for parent, child in self.channels:
+            parent.setblocking(False)
+
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def channel(self, process):
+        '''
+        Return the arguments worker process `process` needs to build its
+        `Receiver`. The daemon keeps them too, connections not received yet
+        by a worker that died go to the one replacing it.
+        '''
+        return self.channels[process][1], self.taken
+
+    def reset(self, process):
+        '''
+        Called when worker process `process` died: connections it did not
+        receive yet are handed to the other worker processes, those it
+        received but did not take are lost.
+        '''
+        channel = self.channels[process][1]
+        connections = []
+
+        while select.select([channel], [], [], 0)[0]:
+            data, fds, flags, address = socket.recv_fds(channel, MAXFDS, MAXFDS)
+            connections.extend(socket.socket(fileno=fd) for fd in fds)
+
+        with self._lock:
+            self.sent[process] = self.taken[process]
+
+        for connection in self._dispatch(connections, [process]):
+            connection.close()
+
+    def load(self, process):
+        '''
+        Return the number of requests worker process `process` is handling
+        plus the number of connections queued for it.
+        '''
+        return self.pool.inflight(process) + self.sent[process] - self.taken[process]
+
+    def start(self):
+        '''
+        Start the thread accepting connections.
+        '''
+        self.listen.setblocking(False)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='elib.daemon.Dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop accepting connections. Connections already handed off are still
+        handled by the workers.
+        '''
+        if self._thread is not None:
+            self._stopping = True
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _accept(self):
+        connections = []
+
+        while len(connections) < self.batch:
+            try:
+                connection, address = self.listen.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Connections reset before being accepted and running out of
+                # file descriptors should not stop the dispatcher.
+                if e.errno not in (errno.ECONNABORTED, errno.EPROTO, errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+
+                sys.stderr.write('Dispatcher failed to accept: %s\n' % e)
+                sys.stderr.flush()
+                time.sleep(BACKOFF)
+                break
+
+            connections.append(connection)
+
+        return connections
+
+    def _assign(self, connections, full):
+        # Give each connection to the least loaded process, counting the ones
+        # assigned earlier in this batch.
+        loads = [self.load(process) if process not in full else None for process in range(self.pool.processes)]
+        assigned = {}
+
+        for connection in connections:
+            process = min((load, process) for process, load in enumerate(loads) if load is not None)[1]
+            loads[process] += 1
+            assigned.setdefault(process, []).append(connection)
+
+        return assigned
+
+    def _send(self, process, connections):
+        # Returns the connections that did not fit in the channel.
+        channel = self.channels[process][0]
+
+        while connections:
+            chunk = connections[:MAXFDS]
+
+            try:
+                socket.send_fds(channel, [b'\0' * len(chunk)], [c.fileno() for c in chunk])
+            except (BlockingIOError, InterruptedError):
+                return connections
+
+            with self._lock:
+                self.sent[process] += len(chunk)
+
+            self.dispatched += len(chunk)
+
+            for connection in chunk:
+                connection.close()
+
+            connections = connections[MAXFDS:]
+
+        return []
+
+    def _dispatch(self, connections, full):
+        # Returns the connections no worker process had room for.
+        full = set(full)
+
+        while connections and len(full) < self.pool.processes:
+            unsent = []
+
+            for process, assigned in self._assign(connections, full).items():
+                left = self._send(process, assigned)
+
+                if left:
+                    full.add(process)
+                    unsent.extend(left)
+
+            connections = unsent
+
+        return connections
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listen, selectors.EVENT_READ)
+        pending = []
+
+        try:
+            while not self._stopping:
+                if not pending:
+                    if not selector.select(POLL):
+                        continue
+
+                    pending = self._accept()
+
+                    if pending:
+                        self.pool.daemon.touch()
+
+                pending = self._dispatch(pending, ())
+
+                if pending:
+                    # Every worker is backed up: stop accepting for a moment,
+                    # new connections wait in the listen backlog.
+                    time.sleep(BACKOFF)
+        finally:
+            selector.close()
+
+            for connection in pending:
+                connection.close()
+
+
+class Receiver(object):
+    '''
+    The `elib.daemon.dispatch.Receiver` class receives the connections sent
+    to a worker process and queues them for its threads.
+    '''
+    def __init__(self, process, channel, taken, stop):
+        self.process = process
+        self.channel = channel
+        self.taken = taken
+        self.stop = stop
+        self.queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='elib.daemon.Receiver')
+        self._thread.daemon = True
+
+    def start(self):
+        '''
+        Start the thread receiving connections.
+        '''
+        self._thread.start()
+
+    def get(self, timeout=None):
+        '''
+        Return the next connection, or None when `timeout` seconds passed or
+        the pool is stopping first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not self.stop.is_set():
+            wait = POLL if deadline is None else min(POLL, deadline - time.monotonic())
+
+            if wait <= 0:
+                return None
+
+            try:
+                connection = self.queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                self.taken[self.process] += 1
+
+            return connection
+
+        return None
+
+    def _run(self):
+        while not self.stop.is_set():
+            if not select.select([self.channel], [], [], POLL)[0]:
+                continue
+
+            try:
+                data, fds, flags, address = socket.recv_fds(self.channel, MAXFDS, MAXFDS)
+            except InterruptedError:
+                continue
+
+            if not data:
+                # The daemon is gone.
+                return
+
+            for fd in fds:
+                self.queue.put(socket.socket(fileno=fd))
+
+        # Close what the worker threads did not take.
+        while True:
+            try:
+                self.queue.get_nowait().close()
+            except queue.Empty:
+                return
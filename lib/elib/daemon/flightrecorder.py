@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.flightrecorder module keeps the most recent events of a
+process in a ring buffer stored in a memory-mapped file.
+
+Recording an event only copies bytes into the mapping, no system calls are
+made. Because the kernel owns the pages of the mapping, the buffer survives
+the process crashing or being killed. The file also reserves an area for
+`faulthandler` output, so a fatal error traceback ends up in the same place.
+
+The file layout is a fixed size header, the ring and the crash area::
+
+    header:  magic, version, ring size, crash area size, head, tail
+    ring:    records of <length:u16> <level:u8> <pad:u8> <time:f64> <message>
+    crash:   text written by faulthandler, NUL padded
+
+`head` and `tail` are monotonically increasing byte positions; a record
+starts at `tail % size`. `head` is only advanced after a record has been
+copied, so a record that was being written during a crash is ignored.
+
+A recorder belongs to the process that created it: in a forked child it
+stops recording, as the child would otherwise overwrite the parent's records
+with its own copy of `head` and `tail`.
+
+Run ``python -m elib.daemon.flightrecorder FILE`` to decode a file.
+'''
+
+
+__all__ = ['FlightRecorder', 'FlightRecorderHandler', 'decode']
+__docformat__ = 'restructuredtext'
+
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import weakref
+
+
+MAGIC = b'ELFR'
+VERSION = 1
+HEADER = struct.Struct('<4sHxxIIQQ')     # magic, version, ring size, crash size, head, tail
+POSITIONS = struct.Struct('<QQ')         # head, tail
+POSITIONS_OFFSET = 16
+RECORD = struct.Struct('<HBxd')          # length, level, timestamp
+SIZE = 1024 * 1024                       # Default ring size.
+CRASHSIZE = 64 * 1024                    # Default crash area size.
+
+# Recorders to detach in forked children.
+_recorders = weakref.WeakSet()
+
+
+class FlightRecorder(object):
+    '''
+    The `elib.daemon.flightrecorder.FlightRecorder` class records events in a
+    memory-mapped ring buffer.
+    '''
+    def __init__(self, path, size=SIZE, crashsize=CRASHSIZE):
+        '''
+        :param path: name of the file backing the ring buffer. An existing
+                     file is renamed to `path` with a `.1` suffix first, so
+                     the events leading up to a crash survive a restart.
+        :param size: size of the ring buffer in bytes.
+                     This argument is optional and defaults to 1 MiB.
+        :param crashsize: size of the area reserved for `faulthandler`
+                          output in bytes.
+                          This argument is optional and defaults to 64 KiB.
+        '''
+        if size < 4 * RECORD.size:
+            raise ValueError('flight recorder size must be at least %d bytes' % (4 * RECORD.size))
+
+        self.path = path
+        self.size = size
+        self.crashsize = crashsize
+        self.maxmessage = min(0xffff, size // 2) - RECORD.size
+
+        self._lock = threading.Lock()
+        self._head = 0
+        self._tail = 0
+        #: True in a forked child, where nothing is recorded
+        self.detached = False
+
+        try:
+            os.rename(path, path + '.1')
+        except FileNotFoundError:
+            pass
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, HEADER.size + size + crashsize)
+        self._map = mmap.mmap(self._fd, HEADER.size + size + crashsize)
+        self._map[0:HEADER.size] = HEADER.pack(MAGIC, VERSION, size, crashsize, 0, 0)
+        _recorders.add(self)
+
+    def record(self, message, level=logging.INFO, timestamp=None):
+        '''
+        Append `message` to the ring buffer, overwriting the oldest records
+        when it is full.
+
+        :param message: text of the record; truncated when it does not fit.
+        :param level: a `logging` level. This argument is optional and
+                      defaults to `logging.INFO`.
+        :param timestamp: time of the event. This argument is optional and
+                          defaults to the current time.
+        '''
+        if self.detached:
+            return
+
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8', 'replace')
+
+        message = message[:self.maxmessage]
+        data = RECORD.pack(RECORD.size + len(message), min(level, 0xff),
+                           time.time() if timestamp is None else timestamp) + message
+
+        with self._lock:
+            # Make room by dropping the oldest records first.
+            while self._head + len(data) - self._tail > self.size:
+                length = RECORD.unpack(self._read(self._tail, RECORD.size))[0]
+                self._tail += length
+
+            self._map[POSITIONS_OFFSET:HEADER.size] = POSITIONS.pack(self._head, self._tail)
+            self._write(self._head, data)
+            self._head += len(data)
+            self._map[POSITIONS_OFFSET:HEADER.size] = POSITIONS.pack(self._head, self._tail)
+
+    def crashfile(self):
+        '''
+        Return a file object positioned at the start of the crash area, to be
+        passed to `faulthandler.enable`. The file object must be kept alive as
+        long as `faulthandler` uses it.
+        '''
+        f = os.fdopen(os.dup(self._fd), 'wb', 0)
+        f.seek(HEADER.size + self.size)
+        return f
+
+    def close(self):
+        '''
+        Unmap the ring buffer. The file stays in place.
+        '''
+        _recorders.discard(self)
+        self._map.close()
+        os.close(self._fd)
+
+    def _detach(self):
+        # The mapping is shared with the parent, leave it to the parent.
+        self.detached = True
+        self._lock = threading.Lock()
+        self.close()
+
+    def _read(self, position, length):
+        start = position % self.size
+        end = start + length
+
+        if end <= self.size:
+            return self._map[HEADER.size + start:HEADER.size + end]
+
+        return self._map[HEADER.size + start:HEADER.size + self.size] + self._map[HEADER.size:HEADER.size + end - self.size]
+
+    def _write(self, position, data):
+        start = position % self.size
+        split = min(len(data), self.size - start)
+        self._map[HEADER.size + start:HEADER.size + start + split] = data[:split]
+
+        if split < len(data):
+            self._map[HEADER.size:HEADER.size + len(data) - split] = data[split:]
+
+
+def _after_fork_in_child():
+    for recorder in list(_recorders):
+        recorder._detach()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class FlightRecorderHandler(logging.Handler):
+    '''
+    The `elib.daemon.flightrecorder.FlightRecorderHandler` class is a
+    `logging.Handler` writing log records to a `FlightRecorder`.
+    '''
+    def __init__(self, recorder, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.recorder = recorder
+
+    def emit(self, record):
+        try:
+            self.recorder.record('%s: %s' % (record.name, self.format(record)), record.levelno, record.created)
+        except Exception:
+            self.handleError(record)
+
+
+def decode(path):
+    '''
+    Read a flight recorder file.
+
+    :returns: a `(records, crash)` tuple where `records` is a list of
+              `(timestamp, level, message)` tuples, oldest first, and
+              `crash` is the text written to the crash area.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, size, crashsize, head, tail = HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a flight recorder file' % path)
+
+    ring = data[HEADER.size:HEADER.size + size]
+    ring = ring + ring
+    records = []
+
+    while tail < head:
+        start = tail % size
+        length, level, timestamp = RECORD.unpack_from(ring, start)
+
+        if length < RECORD.size or tail + length > head:
+            break
+
+        message = ring[start + RECORD.size:start + length].decode('utf-8', 'replace')
+        records.append((timestamp, level, message))
+        tail += length
+
+    crash = data[HEADER.size + size:HEADER.size + size + crashsize].split(b'\0', 1)[0]
+
+    return records, crash.decode('utf-8', 'replace')
+
+
+def main(args):
+    if len(args) != 2:
+        sys.exit('Usage: %s FILE' % args[0])
+
+    records, crash = decode(args[1])
+
+    for timestamp, level, message in records:
+        sys.stdout.write('%s.%03d %s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                                              int(timestamp * 1000) % 1000,
+                                              logging.getLevelName(level),
+                                              message))
+
+    if crash:
+        sys.stdout.write('\n%s' % crash)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
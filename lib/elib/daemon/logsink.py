@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.logsink module sends the output written to a file descriptor
+to the journald or syslog datagram socket.
+
+A `LogSink` replaces the file descriptor with the write end of a pipe. A
+background thread reads whatever is available from the pipe, splits it into
+lines and sends each line as a record tagged with a priority, an identifier
+and the pid. When the socket is full, records are kept in a bounded buffer;
+when that buffer overflows the oldest records are dropped and a notice with
+the number of dropped records is sent once the socket accepts data again.
+'''
+
+
+__all__ = ['LogSink', 'parse', 'JOURNALD', 'SYSLOG']
+__docformat__ = 'restructuredtext'
+
+
+import collections
+import errno
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+
+JOURNALD = 'journald'
+SYSLOG = 'syslog'
+
+ADDRESSES = {JOURNALD: '/run/systemd/journal/socket',
+             SYSLOG: '/dev/log'}
+
+LOG_DAEMON = 3        # syslog facility used for all records.
+MAXRECORDS = 4096     # Default maximum number of records buffered while the socket is full.
+MAXLINE = 8192        # Lines longer than this are split into several records.
+RETRY = 1.0           # Seconds to wait before reconnecting to an unavailable socket.
+
+
+def parse(target):
+    '''
+    Parse a redirection target of the form `journald:[path]` or
+    `syslog:[path]`.
+
+    :returns: a `(protocol, address)` tuple, or None when `target` is a plain
+              file name.
+    '''
+    protocol, sep, address = target.partition(':')
+
+    if not sep or protocol not in ADDRESSES:
+        return None
+
+    return protocol, address or ADDRESSES[protocol]
+
+
+class LogSink(object):
+    '''
+    The `elib.daemon.logsink.LogSink` class forwards everything written to a
+    file descriptor to a journald or syslog socket.
+    '''
+    def __init__(self, protocol, address, priority, ident=None, maxrecords=MAXRECORDS):
+        '''
+        :param protocol: `JOURNALD` or `SYSLOG`.
+        :param address: path of the Unix datagram socket.
+        :param priority: syslog priority of the records, for example
+                         `syslog.LOG_INFO`.
+        :param ident: identifier the records are tagged with. This argument
+                      is optional and defaults to the name of the program.
+        :param maxrecords: number of records buffered while the socket is
+                           full. This argument is optional and defaults to
+                           `MAXRECORDS`.
+        '''
+        if protocol not in ADDRESSES:
+            raise ValueError('unknown log sink protocol \'%s\'' % protocol)
+
+        self.protocol = protocol
+        self.address = address
+        self.priority = priority
+        self.ident = ident or os.path.basename(sys.argv[0]) or 'python'
+        self.dropped = 0
+
+        self._buffer = collections.deque(maxlen=maxrecords)
+        self._partial = b''
+        self._sock = None
+        self._retry = 0
+        self._rfd = None
+        self._wakeup = os.pipe()
+        self._stopping = False
+        self._thread = None
+
+    def redirect(self, fd):
+        '''
+        Replace `fd` with the write end of a pipe and start forwarding what is
+        written to it.
+        '''
+        rfd, wfd = os.pipe()
+        os.dup2(wfd, fd)
+        os.close(wfd)
+        self._rfd = rfd
+
+        self._thread = threading.Thread(target=self._run, name='elib.daemon.LogSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=1.0):
+        '''
+        Forward what is currently waiting in the pipe and stop the background
+        thread.
+        '''
+        if self._thread is None:
+            return
+
+        self._stopping = True
+        os.write(self._wakeup[1], b'x')
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _format(self, line):
+        pid = os.getpid()
+
+        if self.protocol == JOURNALD:
+            return b''.join([b'PRIORITY=%d\n' % self.priority,
+                             b'SYSLOG_FACILITY=%d\n' % LOG_DAEMON,
+                             b'SYSLOG_IDENTIFIER=' + self.ident.encode('utf-8') + b'\n',
+                             b'SYSLOG_PID=%d\n' % pid,
+                             b'MESSAGE=' + line + b'\n'])
+        else:
+            return b'<%d>%s[%d]: %s' % (LOG_DAEMON * 8 + self.priority, self.ident.encode('utf-8'), pid, line)
+
+    def _append(self, line):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+
+        self._buffer.append(self._format(line))
+
+    def _feed(self, data):
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+
+        while len(self._partial) > MAXLINE:
+            lines.append(self._partial[:MAXLINE])
+            self._partial = self._partial[MAXLINE:]
+
+        for line in lines:
+            if line:
+                self._append(line)
+
+    def _connect(self):
+        if self._sock is not None:
+            return True
+
+        if time.time() < self._retry:
+            return False
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            self._retry = time.time() + RETRY
+            return False
+
+        self._sock = sock
+        return True
+
+    def _send(self):
+        # Returns True when the socket is full and we need to wait for it.
+        if not self._connect():
+            return False
+
+        if self.dropped and len(self._buffer) < self._buffer.maxlen:
+            dropped, self.dropped = self.dropped, 0
+            self._buffer.appendleft(self._format(b'elib.daemon: dropped %d records' % dropped))
+
+        while self._buffer:
+            try:
+                self._sock.send(self._buffer[0])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    return True
+                elif e.errno == errno.EMSGSIZE:
+                    # Should not happen given MAXLINE, drop the record.
+                    pass
+                else:
+                    # The socket went away (e.g. journald was restarted).
+                    self._sock.close()
+                    self._sock = None
+                    self._retry = time.time() + RETRY
+                    return False
+
+            self._buffer.popleft()
+
+        return False
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._rfd, select.POLLIN)
+        poller.register(self._wakeup[0], select.POLLIN)
+        waiting = False
+
+        while True:
+            if self._buffer and self._sock is None:
+                timeout = max(0, self._retry - time.time()) * 1000
+            else:
+                timeout = None
+
+            if waiting:
+                poller.register(self._sock.fileno(), select.POLLOUT)
+
+            events = poller.poll(timeout)
+
+            if waiting:
+                poller.unregister(self._sock.fileno())
+
+            eof = False
+
+            for fd, event in events:
+                if fd == self._rfd:
+                    data = os.read(self._rfd, 65536)
+
+                    if data:
+                        self._feed(data)
+                    else:
+                        eof = True
+
+            if self._stopping or eof:
+                # Drain the pipe without blocking and give up on a full socket.
+                while not eof and select.select([self._rfd], [], [], 0)[0]:
+                    data = os.read(self._rfd, 65536)
+                    eof = not data
+                    self._feed(data)
+
+                self._feed(b'\n')
+
+                if self._connect():
+                    self._sock.settimeout(RETRY)
+                    self._send()
+
+                return
+
+            waiting = self._send()
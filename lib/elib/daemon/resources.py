@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.resources module keeps track of process-local resources
+(connection pools, thread pools, random number generators, ...) that must not
+survive a fork.
+
+Libraries register a factory and, optionally, a teardown and a pre-warm
+function. Instances are built lazily by `ResourceRegistry.get`. Right after
+any `os.fork` the child drops the instances it inherited, so no sockets,
+threads or random state end up shared between processes; the parent keeps
+using its own. The inherited instances are not torn down, as that could close
+connections the parent still uses. `Daemon.start` rebuilds them in the final
+daemon process, and `Daemon.notify_ready` pre-warms them before readiness is
+announced. Worker processes of `Daemon.workers` pre-warm their own before
+their threads start.
+'''
+
+
+__all__ = ['ResourceRegistry', 'registry', 'register', 'get']
+__docformat__ = 'restructuredtext'
+
+
+import os
+import sys
+import threading
+
+
+class _Resource(object):
+    def __init__(self, factory, teardown, prewarm):
+        self.factory = factory
+        self.teardown = teardown
+        self.prewarm = prewarm
+
+
+class ResourceRegistry(object):
+    '''
+    The `elib.daemon.resources.ResourceRegistry` class maps names to fork
+    sensitive resources. Most code should use the module level `registry`
+    instance, which is hooked into `os.register_at_fork`.
+    '''
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._resources = {}
+        self._instances = {}
+        self._warmed = set()
+
+    def register(self, name, factory, teardown=None, prewarm=None):
+        '''
+        :param name: name used to look up the resource with `get`.
+        :param factory: callable without arguments returning a new instance.
+        :param teardown: callable receiving an instance, called when the
+                         registry is torn down or the resource is
+                         unregistered. This argument is optional and defaults
+                         to None.
+        :param prewarm: callable receiving an instance, called by `prewarm`
+                        before the daemon announces readiness. Use it to open
+                        connections, fill caches, etc.
+                        This argument is optional and defaults to None.
+        '''
+        if not callable(factory):
+            raise TypeError('factory must be callable, but received a %s' % type(factory))
+
+        with self._lock:
+            if name in self._resources:
+                raise ValueError('resource \'%s\' is already registered' % name)
+
+            self._resources[name] = _Resource(factory, teardown, prewarm)
+
+    def unregister(self, name):
+        '''
+        Tear down the instance of resource `name`, if any, and forget about it.
+        '''
+        with self._lock:
+            self._teardown(name)
+            del self._resources[name]
+
+    def get(self, name):
+        '''
+        Return the instance of resource `name` for the current process,
+        building it first if needed.
+        '''
+        with self._lock:
+            try:
+                return self._instances[name]
+            except KeyError:
+                instance = self._resources[name].factory()
+                self._instances[name] = instance
+                return instance
+
+    def rebuild(self):
+        '''
+        Build an instance of every registered resource that does not have one
+        in the current process.
+        '''
+        with self._lock:
+            for name in list(self._resources):
+                self.get(name)
+
+    def prewarm(self):
+        '''
+        Build every registered resource and call its pre-warm function.
+        Instances that were pre-warmed already are skipped.
+        '''
+        with self._lock:
+            for name, resource in list(self._resources.items()):
+                if name in self._warmed:
+                    continue
+
+                instance = self.get(name)
+
+                if resource.prewarm is not None:
+                    resource.prewarm(instance)
+
+                self._warmed.add(name)
+
+    def teardown(self):
+        '''
+        Tear down all instances in the current process. They will be rebuilt
+        on their next use.
+        '''
+        with self._lock:
+            for name in list(self._instances):
+                self._teardown(name)
+
+    def _teardown(self, name):
+        self._warmed.discard(name)
+        instance = self._instances.pop(name, None)
+
+        if instance is None:
+            return
+
+        teardown = self._resources[name].teardown
+
+        if teardown is not None:
+            try:
+                teardown(instance)
+            except Exception as e:
+                sys.stderr.write('Failed to tear down resource %s: %s\n' % (name, e))
+                sys.stderr.flush()
+
+    def _before_fork(self):
+        # Keep other threads from building an instance while forking.
+        self._lock.acquire()
+
+    def _after_fork_in_parent(self):
+        self._lock.release()
+
+    def _after_fork_in_child(self):
+        # The lock was copied in an acquired state. The instances belong to
+        # the parent, which may be using them in another thread right now.
+        self._lock = threading.RLock()
+        self._instances = {}
+        self._warmed = set()
+
+
+registry = ResourceRegistry()
+register = registry.register
+get = registry.get
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=registry._before_fork,
+                        after_in_parent=registry._after_fork_in_parent,
+                        after_in_child=registry._after_fork_in_child)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.scheduler module runs periodic jobs inside a daemon.
+
+All jobs are kept in a heap ordered by their next run time and a single
+thread sleeps until the earliest one is due, so idle jobs cost nothing but
+their heap entry. Due jobs are handed to a small pool of runner threads. A
+job whose previous run has not finished yet is skipped instead of being run
+twice at the same time.
+'''
+
+
+__all__ = ['Scheduler', 'Job']
+__docformat__ = 'restructuredtext'
+
+
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+import traceback
+
+
+class Job(object):
+    '''
+    The `elib.daemon.scheduler.Job` class describes a periodic job and keeps
+    its runtime statistics.
+    '''
+    def __init__(self, function, interval, jitter, name):
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self.name = name
+        self.cancelled = False
+        self.running = False
+
+        #: number of completed runs
+        self.runs = 0
+        #: number of runs that raised an exception
+        self.failures = 0
+        #: number of runs skipped because the previous run was still busy
+        self.skipped = 0
+        #: duration of the last run in seconds
+        self.last = 0.0
+        #: longest run in seconds
+        self.max = 0.0
+        #: total time spent running in seconds
+        self.total = 0.0
+
+    def cancel(self):
+        '''
+        Stop scheduling this job. A run in progress is not interrupted.
+        '''
+        self.cancelled = True
+
+    def stats(self):
+        '''
+        Return the runtime statistics of this job as a dictionary.
+        '''
+        return {'name': self.name,
+                'runs': self.runs,
+                'failures': self.failures,
+                'skipped': self.skipped,
+                'last': self.last,
+                'max': self.max,
+                'mean': self.total / self.runs if self.runs else 0.0}
+
+    def _delay(self):
+        if self.jitter:
+            return self.interval + random.uniform(0, self.jitter)
+
+        return self.interval
+
+
+class Scheduler(object):
+    '''
+    The `elib.daemon.scheduler.Scheduler` class runs `Job` objects on a
+    timer thread and a fixed number of runner threads.
+    '''
+    def __init__(self, runners=4):
+        '''
+        :param runners: number of threads running due jobs, which is the
+                        maximum number of jobs running at the same time.
+                        This argument is optional and defaults to 4.
+        '''
+        self.runners = runners
+        self.jobs = []
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._due = []
+        self._threads = []
+        self._stopping = False
+
+    def every(self, interval, function, jitter=0, name=None, delay=None):
+        '''
+        Call `function` without arguments every `interval` seconds.
+
+        :param jitter: maximum number of seconds randomly added to each
+                       interval, to keep jobs with the same interval from
+                       running in lockstep.
+                       This argument is optional and defaults to 0.
+        :param name: name used in statistics and error messages.
+                     This argument is optional and defaults to the name of
+                     `function`.
+        :param delay: seconds before the first run.
+                      This argument is optional and defaults to one interval
+                      (plus jitter).
+        :returns: the new `Job`.
+        '''
+        if interval <= 0:
+            raise ValueError('interval must be positive, but received %s' % interval)
+
+        job = Job(function, interval, jitter, name or getattr(function, '__name__', repr(function)))
+
+        with self._condition:
+            self.jobs.append(job)
+            self._push(job, time.monotonic() + (job._delay() if delay is None else delay))
+            self._condition.notify_all()
+
+        return job
+
+    def stats(self):
+        '''
+        Return the statistics of all jobs that were not cancelled.
+        '''
+        return [job.stats() for job in self.jobs if not job.cancelled]
+
+    def start(self):
+        '''
+        Start the timer and runner threads.
+        '''
+        if self._threads:
+            raise RuntimeError('scheduler is already running')
+
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._timer, name='elib.daemon.Scheduler')]
+        self._threads.extend(threading.Thread(target=self._runner, name='elib.daemon.Scheduler-%d' % i)
+                             for i in range(self.runners))
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop scheduling jobs and wait up to `timeout` seconds for running jobs
+        to finish. Jobs that are due but not started yet are not run.
+        '''
+        with self._condition:
+            self._stopping = True
+            del self._due[:]
+            self._condition.notify_all()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+    def _push(self, job, when):
+        heapq.heappush(self._heap, (when, next(self._counter), job))
+
+    def _timer(self):
+        with self._condition:
+            while not self._stopping:
+                now = time.monotonic()
+
+                while self._heap and self._heap[0][0] <= now:
+                    when, count, job = heapq.heappop(self._heap)
+
+                    if job.cancelled:
+                        self.jobs.remove(job)
+                        continue
+
+                    if job.running:
+                        job.skipped += 1
+                    else:
+                        job.running = True
+                        self._due.append(job)
+
+                    # Schedule from the planned time, not from now, so a late
+                    # timer thread does not make the job drift.
+                    self._push(job, max(when + job._delay(), now))
+
+                if self._due:
+                    self._condition.notify_all()
+
+                if self._heap:
+                    self._condition.wait(self._heap[0][0] - now)
+                else:
+                    self._condition.wait()
+
+    def _runner(self):
+        while True:
+            with self._condition:
+                while not self._due and not self._stopping:
+                    self._condition.wait()
+
+                if self._stopping:
+                    return
+
+                job = self._due.pop(0)
+
+            start = time.monotonic()
+
+            try:
+                job.function()
+            except Exception:
+                job.failures += 1
+                sys.stderr.write('Scheduled job %s failed:\n%s' % (job.name, traceback.format_exc()))
+                sys.stderr.flush()
+
+            duration = time.monotonic() - start
+
+            with self._condition:
+                job.running = False
+                job.runs += 1
+                job.last = duration
+                job.total += duration
+                job.max = max(job.max, duration)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.state module hands warm state (caches, indexes, ...) from one
+generation of a daemon to the next.
+
+The state is kept in a memory-mapped file. The running generation fills a
+writable mapping of a new file and, during graceful shutdown, commits it: a
+header with a checksum is written, the file is flushed to disk and renamed
+over the previous one. The next generation maps that file copy-on-write and
+only accepts it when the header matches its own state version and the
+checksum is correct, so stale or torn state is never used.
+'''
+
+
+__all__ = ['StateArea']
+__docformat__ = 'restructuredtext'
+
+
+import mmap
+import os
+import struct
+import zlib
+
+
+MAGIC = b'ELST'
+FORMAT = 1
+HEADER = struct.Struct('<4sHxx64sQI')    # magic, format, state version, length, crc32
+
+
+class StateArea(object):
+    '''
+    The `elib.daemon.state.StateArea` class manages the state file of a
+    daemon.
+    '''
+    def __init__(self, path, version):
+        '''
+        :param path: name of the state file.
+        :param version: version of the state layout, a string of at most 64
+                        bytes. State written with another version is
+                        rejected.
+        '''
+        if not isinstance(version, bytes):
+            version = str(version).encode('utf-8')
+
+        if len(version) > 64:
+            raise ValueError('state version must be at most 64 bytes long')
+
+        self.path = path
+        self.version = version
+        self.previous = None
+        self.rejected = None
+        self.buffer = None
+
+        self._previous = None
+        self._map = None
+        self._fd = None
+
+    def load(self):
+        '''
+        Map the state left by the previous generation copy-on-write. When it
+        is valid it is available as the `previous` memoryview, otherwise the
+        reason it was rejected is stored in `rejected`.
+
+        :returns: the `previous` memoryview, or None.
+        '''
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            self.rejected = 'no state file'
+            return None
+
+        try:
+            size = os.fstat(fd).st_size
+
+            if size < HEADER.size:
+                self.rejected = 'truncated state file'
+                return None
+
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_COPY)
+        finally:
+            os.close(fd)
+
+        magic, format, version, length, crc = HEADER.unpack_from(m)
+
+        if magic != MAGIC or format != FORMAT:
+            self.rejected = 'not a state file'
+        elif version.rstrip(b'\0') != self.version:
+            self.rejected = 'state version %r does not match %r' % (version.rstrip(b'\0'), self.version)
+        elif HEADER.size + length > size:
+            self.rejected = 'truncated state file'
+        elif zlib.crc32(memoryview(m)[HEADER.size:HEADER.size + length]) & 0xffffffff != crc:
+            self.rejected = 'state checksum mismatch'
+        else:
+            self._previous = m
+            self.previous = memoryview(m)[HEADER.size:HEADER.size + length]
+            return self.previous
+
+        m.close()
+        return None
+
+    def release(self):
+        '''
+        Unmap the state of the previous generation once it has been used.
+        '''
+        if self._previous is not None:
+            self.previous.release()
+            self._previous.close()
+            self.previous = self._previous = None
+
+    def create(self, size):
+        '''
+        Create the state for the next generation.
+
+        :param size: size of the state in bytes.
+        :returns: a writable memoryview of `size` bytes, also available as
+                  `buffer`, for the application to fill.
+        '''
+        if self._map is not None:
+            raise RuntimeError('state was already created')
+
+        self._fd = os.open(self.path + '.new', os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self._fd, HEADER.size + size)
+        self._map = mmap.mmap(self._fd, HEADER.size + size)
+        self.buffer = memoryview(self._map)[HEADER.size:]
+        return self.buffer
+
+    def commit(self):
+        '''
+        Checksum the state, flush it to disk and make it the state the next
+        generation loads. Does nothing when `create` was not called.
+        '''
+        if self._map is None:
+            return
+
+        length = len(self.buffer)
+        crc = zlib.crc32(self.buffer) & 0xffffffff
+        self._map[:HEADER.size] = HEADER.pack(MAGIC, FORMAT, self.version, length, crc)
+        self._map.flush()
+        os.fsync(self._fd)
+        os.rename(self.path + '.new', self.path)
+
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        # The state is handed over, unmapping is best effort: it fails while
+        # the application still holds views of `buffer` (ctypes, numpy).
+        try:
+            self.buffer.release()
+            self._map.close()
+        except BufferError:
+            pass
+
+        os.close(self._fd)
+        self.buffer = self._map = self._fd = None
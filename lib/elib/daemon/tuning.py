@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.tuning module applies process tuning settings for latency
+sensitive daemons. A tuning profile is a dictionary with any of the following
+keys:
+
+`nofile`
+    soft limit for the number of open files, an int or `'max'` for the hard
+    limit.
+`mlockall`
+    True to lock all current and future pages in memory.
+`sched`
+    `(policy, priority)` tuple, where policy is one of `'other'`, `'batch'`,
+    `'idle'`, `'fifo'` or `'rr'`.
+`nice`
+    nice value between -20 and 19.
+`ioprio`
+    `(class, level)` tuple, where class is one of `'realtime'`,
+    `'best-effort'` or `'idle'` and level is between 0 and 7.
+`oom_score_adj`
+    value between -1000 and 1000 written to `/proc/self/oom_score_adj`.
+`thp`
+    False to disable transparent huge pages for the process, True to allow
+    them again.
+
+Most settings that make a process more important than others (locking
+memory, real-time scheduling, negative nice values, lowering
+`oom_score_adj`) need privileges or raised resource limits.
+'''
+
+
+__all__ = ['validate', 'apply']
+__docformat__ = 'restructuredtext'
+
+
+import os
+import resource
+
+
+SCHED_POLICIES = ['other', 'batch', 'idle', 'fifo', 'rr']
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+PR_SET_THP_DISABLE = 41
+
+# ioprio_set has no libc wrapper, these are its system call numbers.
+SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                  'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+
+ORDER = ['nofile', 'mlockall', 'sched', 'nice', 'ioprio', 'oom_score_adj', 'thp']
+
+
+def _integer(name, value, low, high):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError('%s must be an int, but received a %s' % (name, type(value)))
+
+    if not low <= value <= high:
+        raise ValueError('%s must be between %d and %d, but received %d' % (name, low, high, value))
+
+
+def validate(profile):
+    '''
+    Check the settings of a tuning profile.
+
+    :raises TypeError: if a setting has the wrong type.
+    :raises ValueError: if a setting is unknown or out of range.
+    '''
+    if not isinstance(profile, dict):
+        raise TypeError('tuning must be a dict, but received a %s' % type(profile))
+
+    for name, value in profile.items():
+        if name == 'nofile':
+            if value != 'max':
+                _integer(name, value, 0, 2 ** 63)
+        elif name in ('mlockall', 'thp'):
+            if not isinstance(value, bool):
+                raise TypeError('%s must be a bool, but received a %s' % (name, type(value)))
+        elif name == 'sched':
+            policy, priority = value
+
+            if policy not in SCHED_POLICIES:
+                raise ValueError('sched policy must be one of %s, but received \'%s\'' % (', '.join(SCHED_POLICIES), policy))
+
+            if policy in ('fifo', 'rr'):
+                _integer('sched priority', priority, 1, 99)
+            else:
+                _integer('sched priority', priority, 0, 0)
+        elif name == 'nice':
+            _integer(name, value, -20, 19)
+        elif name == 'ioprio':
+            cls, level = value
+
+            if cls not in IOPRIO_CLASSES:
+                raise ValueError('ioprio class must be one of %s, but received \'%s\'' % (', '.join(sorted(IOPRIO_CLASSES)), cls))
+
+            _integer('ioprio level', level, 0, 7)
+        elif name == 'oom_score_adj':
+            _integer(name, value, -1000, 1000)
+        else:
+            raise ValueError('unknown tuning setting \'%s\'' % name)
+
+
+def _libc():
+    import ctypes
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def _check(result):
+    if result != 0:
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def _nofile(value):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    new = hard if value == 'max' else value
+    resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+    return '%s -> %s' % (soft, new)
+
+
+def _mlockall(value):
+    if value:
+        _check(_libc().mlockall(MCL_CURRENT | MCL_FUTURE))
+        return 'locked'
+    else:
+        _check(_libc().munlockall())
+        return 'unlocked'
+
+
+def _sched(value):
+    policy, priority = value
+    os.sched_setscheduler(0, getattr(os, 'SCHED_' + policy.upper()), os.sched_param(priority))
+    return '%s %d' % (policy, priority)
+
+
+def _nice(value):
+    old = os.getpriority(os.PRIO_PROCESS, 0)
+    os.setpriority(os.PRIO_PROCESS, 0, value)
+    return '%d -> %d' % (old, value)
+
+
+def _ioprio(value):
+    cls, level = value
+    number = SYS_IOPRIO_SET.get(os.uname()[4])
+
+    if number is None:
+        raise OSError('ioprio_set is not supported on %s' % os.uname()[4])
+
+    _check(_libc().syscall(number, IOPRIO_WHO_PROCESS, 0, (IOPRIO_CLASSES[cls] << IOPRIO_CLASS_SHIFT) | level))
+    return '%s %d' % (cls, level)
+
+
+def _oom_score_adj(value):
+    with open('/proc/self/oom_score_adj', 'r+') as f:
+        old = f.read().strip()
+        f.write(str(value))
+
+    return '%s -> %d' % (old, value)
+
+
+def _thp(value):
+    _check(_libc().prctl(PR_SET_THP_DISABLE, int(not value), 0, 0, 0))
+    return 'enabled' if value else 'disabled'
+
+
+def apply(profile):
+    '''
+    Apply the settings of a validated tuning profile to the current process.
+    A setting that fails does not prevent the others from being applied.
+
+    :returns: a list of `(name, ok, message)` tuples, one per setting.
+    '''
+    report = []
+
+    for name in ORDER:
+        if name not in profile:
+            continue
+
+        try:
+            message = globals()['_' + name](profile[name])
+        except (OSError, IOError, ValueError, AttributeError) as e:
+            report.append((name, False, str(e)))
+        else:
+            report.append((name, True, message))
+
+    return report
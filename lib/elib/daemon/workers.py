@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2007-2010 Dieter Verfaillie <dieterv@optionexplicit.be>
+#
+# This file is part of elib.daemon.
+#
+# elib.daemon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# elib.daemon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with elib.daemon. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+The elib.daemon.workers module runs a worker function in N processes with M
+threads each.
+
+Every worker thread has a slot in shared memory holding its heartbeat, the
+number of requests it handled and the number of requests it is handling
+right now, so the daemon can see how each thread is doing without talking to
+it. A crashing worker process only takes its own threads down, the daemon
+starts a new one in its place.
+
+With the GIL, threads in one process cannot run Python code in parallel, so
+the default layout is one single threaded process per CPU. On free-threaded
+builds (Python 3.13t and later running with the GIL disabled) the default is
+fewer processes with more threads each, which needs much less memory per CPU
+while a process boundary still limits the damage of a crash.
+'''
+
+
+__all__ = ['WorkerPool', 'WorkerContext', 'layout', 'freethreaded']
+__docformat__ = 'restructuredtext'
+
+
+import faulthandler
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+
+THREADS = 8      # Default number of threads per process on free-threaded builds.
+
+
+def freethreaded():
+    '''
+    Return True when the interpreter runs without the GIL.
+    '''
+    return hasattr(sys, '_is_gil_enabled') and not sys._is_gil_enabled()
+
+
+def _cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def layout(processes=None, threads=None):
+    '''
+    Complete a worker layout, filling in what was not given based on the
+    number of usable CPUs and on whether the interpreter is free-threaded.
+
+    :returns: a `(processes, threads)` tuple.
+    '''
+    cpus = _cpus()
+
+    if threads is None:
+        if processes is not None:
+            threads = max(1, cpus // processes) if freethreaded() else 1
+        else:
+            threads = min(cpus, THREADS) if freethreaded() else 1
+
+    if processes is None:
+        processes = max(1, -(-cpus // threads))
+
+    if processes < 1 or threads < 1:
+        raise ValueError('a worker layout needs at least one process and one thread')
+
+    return processes, threads
+
+
+class WorkerContext(object):
+    '''
+    The `elib.daemon.workers.WorkerContext` class is passed to the worker
+    function, one per thread. Use it to report progress and to find out when
+    to stop.
+    '''
+    def __init__(self, slot, process, thread, slots, stop, receiver=None):
+        #: index of this thread among all worker threads
+        self.slot = slot
+        #: index of the worker process
+        self.process = process
+        #: index of this thread within its process
+        self.thread = thread
+
+        self._heartbeats, self._requests, self._inflight = slots
+        self._stop = stop
+        self._receiver = receiver
+
+    @property
+    def stopping(self):
+        '''
+        True once the pool is shutting down. Finish the current request and
+        return from the worker function.
+        '''
+        return self._stop.is_set()
+
+    def wait(self, timeout):
+        '''
+        Sleep up to `timeout` seconds, returning early with True when the pool
+        is shutting down.
+        '''
+        return self._stop.wait(timeout)
+
+    def accept(self, timeout=None):
+        '''
+        Return the next connection the daemon handed to this worker process,
+        as a `socket.socket`, or None when `timeout` seconds passed or the
+        pool is shutting down first. Only available for pools created with a
+        `listen` socket. The connection counts as a request in flight right
+        away: call `end` when done with it.
+        '''
+        if self._receiver is None:
+            raise RuntimeError('worker pool was created without a listen socket')
+
+        connection = self._receiver.get(timeout)
+
+        if connection is not None:
+            self.begin()
+
+        return connection
+
+    def heartbeat(self):
+        '''
+        Report that this thread is alive.
+        '''
+        self._heartbeats[self.slot] = time.time()
+
+    def begin(self):
+        '''
+        Report the start of a request.
+        '''
+        self._inflight[self.slot] += 1
+        self._heartbeats[self.slot] = time.time()
+
+    def end(self):
+        '''
+        Report the end of a request started with `begin`.
+        '''
+        self._inflight[self.slot] -= 1
+        self._requests[self.slot] += 1
+        self._heartbeats[self.slot] = time.time()
+
+
+def _thread(target, context, args):
+    try:
+        target(context, *args)
+    except Exception:
+        sys.stderr.write('Worker %d thread %d failed:\n%s' % (context.process, context.thread, traceback.format_exc()))
+        sys.stderr.flush()
+    finally:
+        context._heartbeats[context.slot] = 0.0
+
+
+def _process(target, args, process, threads, slots, stop, signals, channel=None):
+    # Do not run the daemon's signal handlers in workers: SIGTERM stops the
+    # worker gracefully, the daemon handles everything else. The others are
+    # ignored rather than reset, the default action of most of them kills
+    # the worker when a signal is sent to the whole process group. Only
+    # SIGCHLD gets its default back, ignoring it would reap children the
+    # worker waits for.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    for signum in signals:
+        faulthandler.unregister(signum)
+        signal.signal(signum, signal.SIG_DFL if signum == signal.SIGCHLD else signal.SIG_IGN)
+
+    # The resources inherited from the daemon were dropped after forking,
+    # build and pre-warm our own before taking requests. Failing that they
+    # are built on first use.
+    from elib.daemon import resources
+
+    try:
+        resources.registry.prewarm()
+    except Exception:
+        sys.stderr.write('Worker %d failed to pre-warm resources:\n%s' % (process, traceback.format_exc()))
+        sys.stderr.flush()
+
+    receiver = None
+
+    if channel is not None:
+        from elib.daemon.dispatch import Receiver
+        receiver = Receiver(process, channel[0], channel[1], stop)
+        receiver.start()
+
+    pool = []
+
+    for thread in range(threads):
+        slot = process * threads + thread
+        context = WorkerContext(slot, process, thread, slots, stop, receiver)
+        context.heartbeat()
+        t = threading.Thread(target=_thread, args=(target, context, args), name='Worker-%d-%d' % (process, thread))
+        t.start()
+        pool.append(t)
+
+    for t in pool:
+        t.join()
+
+
+class WorkerPool(object):
+    '''
+    The `elib.daemon.workers.WorkerPool` class starts and supervises worker
+    processes.
+    '''
+    def __init__(self, daemon, target, processes=None, threads=None, args=(), listen=None):
+        '''
+        :param daemon: the `elib.daemon.Daemon` whose `Daemon.spawn` starts
+                       the worker processes.
+        :param target: function called in every worker thread with a
+                       `WorkerContext` followed by `args`. With the
+                       `forkserver` and `exec` spawn methods it must be
+                       importable by name.
+        :param processes: number of worker processes.
+        :param threads: number of threads per worker process.
+                        The layout defaults are computed by `layout`.
+        :param args: extra arguments for `target`.
+        :param listen: a listening socket. When given, the daemon accepts
+                       connections and hands each to the least loaded worker
+                       process, where `WorkerContext.accept` returns it. See
+                       `elib.daemon.dispatch`. Create it after
+                       `Daemon.start`, which closes all file descriptors.
+                       This argument is optional and defaults to None.
+        '''
+        self.daemon = daemon
+        self.target = target
+        self.processes, self.threads = layout(processes, threads)
+        self.args = tuple(args)
+
+        context = daemon._context()
+        size = self.processes * self.threads
+        self._slots = (context.RawArray('d', size), context.RawArray('Q', size), context.RawArray('q', size))
+        self._stop = context.Event()
+        self._processes = [None] * self.processes
+        self._handled = 0
+        self.restarts = 0
+
+        # Every signal the daemon handles, SIGTERM and SIGINT get their own
+        # handlers in workers.
+        signals = set(daemon.sigmap) | set([daemon.stacksignal, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD])
+        self._signals = sorted(signals - set([None, signal.SIGTERM, signal.SIGINT]))
+
+        #: the `elib.daemon.dispatch.Dispatcher`, when created with `listen`
+        self.dispatcher = None
+
+        if listen is not None:
+            from elib.daemon.dispatch import Dispatcher
+            self.dispatcher = Dispatcher(self, listen)
+
+    def start(self):
+        '''
+        Start all worker processes.
+        '''
+        for process in range(self.processes):
+            self._spawn(process)
+
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+
+    def supervise(self):
+        '''
+        Start a new worker process in place of each one that died. The daemon
+        calls this periodically for pools created with `Daemon.workers`.
+        '''
+        if self._stop.is_set():
+            return
+
+        for process, worker in enumerate(self._processes):
+            if worker is not None and not worker.is_alive():
+                worker.join()
+                sys.stderr.write('Worker %d (pid %d) exited with %s, restarting\n' % (process, worker.pid, worker.exitcode))
+                sys.stderr.flush()
+                self.restarts += 1
+
+                if self.dispatcher is not None:
+                    self.dispatcher.reset(process)
+
+                self._spawn(process)
+
+    def stop(self, timeout=10.0):
+        '''
+        Ask all worker threads to stop and wait up to `timeout` seconds for
+        the processes to exit before killing the remaining ones.
+        '''
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+
+        self._stop.set()
+        deadline = time.time() + timeout
+
+        for worker in self._processes:
+            if worker is not None:
+                worker.join(max(0, deadline - time.time()))
+
+                if worker.is_alive():
+                    worker.kill()
+                    worker.join()
+
+    def inflight(self, process):
+        '''
+        Return the number of requests worker process `process` is handling.
+        '''
+        start = process * self.threads
+        return sum(self._slots[2][start:start + self.threads])
+
+    def busy(self):
+        '''
+        Return True when requests are in flight or queued, or requests were
+        handled since the previous call.
+        '''
+        heartbeats, requests, inflight = self._slots
+        handled = sum(requests)
+        busy = handled != self._handled or any(inflight)
+        self._handled = handled
+
+        if self.dispatcher is not None:
+            busy = busy or any(self.dispatcher.load(process) for process in range(self.processes))
+
+        return busy
+
+    def stats(self):
+        '''
+        Return a dictionary per worker thread with the pid of its process, the
+        age of its last heartbeat in seconds (None when the thread is not
+        running), the number of requests handled and in flight.
+        '''
+        heartbeats, requests, inflight = self._slots
+        now = time.time()
+        result = []
+
+        for slot in range(self.processes * self.threads):
+            worker = self._processes[slot // self.threads]
+            result.append({'slot': slot,
+                           'pid': worker.pid if worker is not None else None,
+                           'heartbeat': now - heartbeats[slot] if heartbeats[slot] else None,
+                           'requests': requests[slot],
+                           'inflight': inflight[slot]})
+
+        return result
+
+    def _spawn(self, process):
+        start = process * self.threads
+
+        for slot in range(start, start + self.threads):
+            self._slots[0][slot] = 0.0
+            self._slots[2][slot] = 0
+
+        channel = self.dispatcher.channel(process) if self.dispatcher is not None else None
+        self._processes[process] = self.daemon.spawn(_process,
+                                                     args=(self.target, self.args, process, self.threads, self._slots, self._stop, self._signals, channel),
+                                                     name='Worker-%d' % process)
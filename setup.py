@@ -51,12 +51,15 @@ setup(namespace_packages=['elib'],
            'Natural Language :: English',
            'Operating System :: POSIX',
            'Programming Language :: Python',
+           'Programming Language :: Python :: 3',
            'Topic :: System',
            'Topic :: Software Development :: Libraries :: Python Modules'],
 
+      python_requires = '>=3.9',
       install_requires = ['distribute'],
       zip_safe = False,
       include_package_data = True,
 
+      scripts = ['bin/elib-daemon'],
       packages = find_packages('lib'),
       package_dir = {'': 'lib'})